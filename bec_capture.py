@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import os
+import struct
+import time
+import bec_rcon
+
+# Capture file layout (all little endian):
+#   file header: magic b'BECAP', format version (uint8), wall clock start time in ns (uint64)
+#   record:      direction (uint8), ns since the capture started (uint64), payload length (uint16), payload
+# A capture cut short by a crash simply ends at the last complete record.
+# Outbound login packets are recorded without the password, so captures can be passed around.
+
+CAPTURE_MAGIC = b'BECAP'
+CAPTURE_VERSION = 1
+FILE_HEADER = struct.Struct('<5sBQ')
+RECORD_HEADER = struct.Struct('<BQH')
+
+INBOUND = 0
+OUTBOUND = 1
+
+LOGIN_HEADER_BYTES = 8   # 'BE', CRC32, 0xFF, packet type 0x00
+
+
+def capture_file_path(path: str) -> str:
+    """path with the local start time added before the extension, e.g. session-20240131-184500.becap,
+    and a counter if that file exists already, so no capture overwrites an earlier one."""
+
+    stem, extension = os.path.splitext(path)
+    stem += time.strftime('-%Y%m%d-%H%M%S')
+    candidate, number = stem + extension, 1
+    while os.path.exists(candidate):
+        candidate = f'{stem}-{number}{extension}'
+        number += 1
+    return candidate
+
+
+class Capture_Recorder:
+    """Writes every datagram an ARC sends or receives to a new compact binary capture file, named after path and the
+    time the capture started (see capture_file_path)."""
+
+    def __init__(self, path: str):
+        self.path = capture_file_path(path)
+        self.datagrams = 0
+        self.started_ns = time.monotonic_ns()
+        self.capture_file = open(self.path, 'xb')
+        self.capture_file.write(FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, time.time_ns()))
+        return
+
+    def record(self, direction: int, data: bytes):
+        """Write one datagram, stamped with the time since the capture started."""
+
+        if self.capture_file is None: return
+        self.capture_file.write(RECORD_HEADER.pack(direction, time.monotonic_ns() - self.started_ns, len(data)))
+        self.capture_file.write(data)
+        self.datagrams += 1
+        return
+
+    def inbound(self, data: bytes):
+        self.record(INBOUND, data)
+
+    def outbound(self, data: bytes):
+        # The payload of a login packet is the RCON password. Replay never sends outbound records, so cut it off.
+        if len(data) > LOGIN_HEADER_BYTES and data[7] == 0x00: data = data[:LOGIN_HEADER_BYTES]
+        self.record(OUTBOUND, data)
+
+    def close(self):
+        if self.capture_file is None: return
+        self.capture_file.close()
+        self.capture_file = None
+        return
+
+
+def read_capture(path: str):
+    """Yield (direction, offset_ns, payload) for every complete record in a capture file."""
+
+    with open(path, 'rb') as capture_file:
+        magic, version, _ = FILE_HEADER.unpack(capture_file.read(FILE_HEADER.size))
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise Exception(f'{path} is not a version {CAPTURE_VERSION} BEC capture file')
+
+        while True:
+            header = capture_file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size: return
+            direction, offset_ns, length = RECORD_HEADER.unpack(header)
+            payload = capture_file.read(length)
+            if len(payload) < length: return
+            yield direction, offset_ns, payload
+
+
+class Sink_Socket:
+    """Stands in for the UDP socket of a replayed ARC. Outbound datagrams are counted and dropped."""
+
+    def __init__(self):
+        self.datagrams_sent = 0
+        self.bytes_sent = 0
+
+    def send(self, data: bytes):
+        self.datagrams_sent += 1
+        self.bytes_sent += len(data)
+        return len(data)
+
+    def recv(self, size: int):
+        raise BlockingIOError()
+
+    def close(self):
+        return
+
+
+class Replay_ARC(bec_rcon.ARC):
+    """An ARC that never touches the network, so a capture can be fed through the real decoder.
+    Pass it to Server_Bridge as bec_client to replay through the bridge as well."""
+
+    def __init__(self, options={}):
+        super().__init__('127.0.0.1', 'replay', 2302, options)
+
+    def connect(self):
+        self.sendLock = False
+        self.serverMessageWindow.clear()
+        self.socket = Sink_Socket()
+        self.disconnected = False
+
+
+class Capture_Replayer:
+    """Feeds the inbound datagrams of a capture back through an ARC.
+    speed 1.0 replays at the recorded pace, larger values replay faster, 0 replays as fast as possible."""
+
+    def __init__(self, path: str, bec_client: bec_rcon.ARC = None, speed: float = 1.0):
+        self.path = path
+        self.bec_client = bec_client if bec_client is not None else Replay_ARC()
+        self.speed = speed
+        return
+
+    async def replay(self, settle_timeout_s: float = 30):
+        """Replay the capture and return throughput statistics.
+        Once every datagram is fed, waits up to settle_timeout_s for the tasks the replay spawned
+        (event handlers, bridge relays) so that their cost shows up in the total."""
+
+        loop = asyncio.get_event_loop()
+        tasks_before = asyncio.all_tasks()
+        stats = {
+            "datagrams": 0,
+            "bytes": 0,
+            "outbound_skipped": 0,
+            "decode_errors": 0,
+            "decode_s": 0.0,
+        }
+
+        replay_start = loop.time()
+        for direction, offset_ns, payload in read_capture(self.path):
+
+            # Outbound traffic is regenerated by the ARC itself (acks, keep alives), so only count it.
+            if direction == OUTBOUND:
+                stats["outbound_skipped"] += 1
+                continue
+
+            if self.speed:
+                delay = replay_start + offset_ns / 1e9 / self.speed - loop.time()
+                if delay > 0: await asyncio.sleep(delay)
+
+            decode_start = time.perf_counter()
+            try:
+                self.bec_client.handlePacket(payload)
+            except Exception:
+                stats["decode_errors"] += 1
+            stats["decode_s"] += time.perf_counter() - decode_start
+            stats["datagrams"] += 1
+            stats["bytes"] += len(payload)
+
+            # Let the spawned handlers run now and then when replaying flat out.
+            if not self.speed and stats["datagrams"] % 256 == 0: await asyncio.sleep(0)
+
+        stats["feed_s"] = loop.time() - replay_start
+
+        # Server messages are decoded and dispatched in callbacks right after their ack; let those spawn their tasks.
+        await asyncio.sleep(0)
+        spawned = asyncio.all_tasks() - tasks_before - {asyncio.current_task()}
+        if spawned: await asyncio.wait(spawned, timeout=settle_timeout_s)
+
+        stats["total_s"] = loop.time() - replay_start
+        stats["datagrams_per_s"] = stats["datagrams"] / stats["total_s"] if stats["total_s"] else 0.0
+        stats["decode_datagrams_per_s"] = stats["datagrams"] / stats["decode_s"] if stats["decode_s"] else 0.0
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a BEC capture through the RCON decoder.')
+    parser.add_argument('capture', help='capture file written by ARC.startRecording()')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='1 = recorded pace, 10 = ten times faster, 0 = as fast as possible (default)')
+    args = parser.parse_args()
+
+    async def run():
+        return await Capture_Replayer(args.capture, speed=args.speed).replay()
+
+    for key, value in asyncio.get_event_loop().run_until_complete(run()).items():
+        print(f'{key}: {value}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import asyncio
+import bec_rcon
+from bec_outbound import PLAIN_MESSAGE
+
+# Fan-out helpers over several ARC clients. clients is always a mapping of {server alias: ARC};
+# every server is talked to concurrently and one bad server never fails the others.
+
+
+async def fleet_batch(clients: dict, commands: list) -> dict:
+    """Send the same batch of commands to every server. Returns {alias: [Command_Result, ...]}."""
+
+    async def run(bec_client: bec_rcon.ARC):
+        try:
+            return await bec_client.commandBatch(commands)
+        except Exception as e:  # e.g. the send lock could not be taken in time
+            return [bec_rcon.Command_Result(command, None, e) for command in commands]
+
+    aliases = list(clients)
+    results = await asyncio.gather(*(run(clients[alias]) for alias in aliases))
+    return dict(zip(aliases, results))
+
+
+async def fleet_command(clients: dict, command: str) -> dict:
+    """Send one command to every server. Returns {alias: Command_Result}."""
+
+    return {alias: results[0] for alias, results in (await fleet_batch(clients, [command])).items()}
+
+
+async def fleet_say(clients: dict, message: str, background: bool = False) -> dict:
+    """Broadcast a global chat message to every server, cut to each server's sayLimitBytes.
+    Returns {alias: Command_Result}.
+    background messages wait for every other command to a server to go first, see ARC.send()."""
+
+    async def run(bec_client: bec_rcon.ARC):
+        say = bec_client.sayCommand(-1, PLAIN_MESSAGE, message=message)
+        try:
+            if background:
+                return bec_rcon.Command_Result(say[0], await bec_client.sayGlobal(message, background=True), None)
+            return (await bec_client.commandBatch([say]))[0]
+        except Exception as e:  # e.g. the send lock could not be taken in time
+            return bec_rcon.Command_Result(say[0], None, e)
+
+    aliases = list(clients)
+    results = await asyncio.gather(*(run(clients[alias]) for alias in aliases))
+    return dict(zip(aliases, results))
+
+
+async def fleet_players(clients: dict) -> dict:
+    """Snapshot the player lists of every server. Returns {alias: Command_Result} where response is the
+    parsed player array, see ARC.getPlayersArray()."""
+
+    snapshot = await fleet_command(clients, 'players')
+    return {
+        alias: result if result.error is not None else result._replace(
+            response=clients[alias].parsePlayers(result.response))
+        for alias, result in snapshot.items()}
@@ -0,0 +1,112 @@
+import time
+from array import array
+
+
+class Message_History:
+    """Compact ring buffer of recent messages, used by ARC for server messages and command answers.
+
+    Instead of a [datetime, str] list per message, entries live in parallel arrays: monotonic timestamps,
+    and offsets and lengths into one bytearray holding the UTF-8 text. Text is decoded when read.
+    Retention is by count (max_count) and optionally by total text size (max_bytes); the oldest entries go first.
+
+    Every entry gets a sequence number that keeps counting across evictions. A cursor is such a number:
+    read_since(cursor) returns what was added after it, so consumers can read incrementally."""
+
+    def __init__(self, max_count: int = 100, max_bytes: int = None):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.stamps = array('d')    # time.monotonic() when the entry was added
+        self.offsets = array('Q')   # start of the entry's text in self.data
+        self.lengths = array('L')   # length of the entry's text in self.data
+        self.data = bytearray()
+        self.head = 0               # index of the oldest live entry; entries before it are dead, awaiting compaction
+        self.first_sequence = 0     # sequence number of the entry at self.head
+        self.live_bytes = 0
+        # offset between monotonic and wall clock time, for to_snapshot() and wall_time()
+        self.wall_offset = time.time() - time.monotonic()
+        return
+
+    def __len__(self):
+        return len(self.stamps) - self.head
+
+    def __iter__(self):
+        """(monotonic timestamp, text) pairs, oldest first."""
+        for index in range(self.head, len(self.stamps)):
+            yield self.stamps[index], self.text_at(index)
+
+    def cursor(self) -> int:
+        """Cursor positioned after the newest entry."""
+        return self.first_sequence + len(self)
+
+    def text_at(self, index: int) -> str:
+        offset = self.offsets[index]
+        return self.data[offset:offset + self.lengths[index]].decode('utf-8', 'replace')
+
+    def append(self, text, stamp: float = None):
+        """Add a message, given as str or UTF-8 bytes. Returns its sequence number."""
+
+        body = text.encode('utf-8', 'replace') if isinstance(text, str) else text
+        self.stamps.append(time.monotonic() if stamp is None else stamp)
+        self.offsets.append(len(self.data))
+        self.lengths.append(len(body))
+        self.data += body
+        self.live_bytes += len(body)
+
+        while len(self) > self.max_count or (
+                self.max_bytes is not None and self.live_bytes > self.max_bytes and len(self) > 1):
+            self.live_bytes -= self.lengths[self.head]
+            self.head += 1
+            self.first_sequence += 1
+        if self.head > 64 and self.head * 2 > len(self.stamps): self.compact()
+
+        return self.cursor() - 1
+
+    def compact(self):
+        """Drop evicted entries from the arrays and their text from the buffer."""
+
+        base = self.offsets[self.head] if self.head < len(self.offsets) else len(self.data)
+        del self.stamps[:self.head]
+        del self.offsets[:self.head]
+        del self.lengths[:self.head]
+        del self.data[:base]
+        for index in range(len(self.offsets)): self.offsets[index] -= base
+        self.head = 0
+
+    def get(self, sequence: int):
+        """(timestamp, text) of the entry with this sequence number, or None if it is evicted or not there yet."""
+
+        index = sequence - self.first_sequence + self.head
+        if sequence < self.first_sequence or index >= len(self.stamps): return None
+        return self.stamps[index], self.text_at(index)
+
+    def latest(self):
+        return self.get(self.cursor() - 1)
+
+    def read_since(self, cursor: int):
+        """Return ([(timestamp, text), ...], new cursor) for everything added after cursor.
+        Entries already evicted since the cursor are skipped."""
+
+        start = max(cursor, self.first_sequence) - self.first_sequence + self.head
+        entries = [(self.stamps[index], self.text_at(index)) for index in range(start, len(self.stamps))]
+        return entries, self.cursor()
+
+    def clear(self):
+        self.first_sequence = self.cursor()
+        self.head = len(self.stamps)
+        self.live_bytes = 0
+        self.compact()
+
+    def nbytes(self) -> int:
+        """Memory held by the history, evicted entries not yet compacted included."""
+        return (len(self.data) + self.stamps.itemsize * len(self.stamps) + self.offsets.itemsize * len(self.offsets) +
+                self.lengths.itemsize * len(self.lengths))
+
+    def wall_time(self, stamp: float) -> float:
+        """Convert an entry timestamp to a time.time() value."""
+        return stamp + self.wall_offset
+
+    def to_snapshot(self) -> list:
+        return [[self.wall_time(stamp), text] for stamp, text in self]
+
+    def load_snapshot(self, rows: list):
+        for wall_time, text in rows: self.append(text, wall_time - self.wall_offset)
@@ -0,0 +1,107 @@
+import string
+import struct
+import zlib
+from collections import OrderedDict
+
+# Longest chat line, in UTF-8 bytes, that Say sends; longer messages are cut (on a character boundary) to fit.
+SAY_LIMIT_BYTES = 255
+
+COMMAND_PREFIX = b'\xff\x01'
+
+
+class Message_Template:
+    """A message format such as '{username}{source}: {content}', split once into its literal text, already encoded,
+    and its fields. Fields named in cached are values that keep coming back (names, fixed prefixes); the builder
+    keeps their encoded bytes around instead of encoding them for every message."""
+
+    def __init__(self, template: str, cached: tuple = ()):
+        self.template = template
+        self.cached = frozenset(cached)
+        self.parts = []   # encoded literal bytes, or the name of a field
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if format_spec or conversion: raise ValueError(f'Template fields take no format or conversion: {template!r}')
+            if literal: self.parts.append(literal.encode('utf-8'))
+            if field is not None: self.parts.append(field)
+        return
+
+    def __repr__(self):
+        return f'Message_Template({self.template!r})'
+
+
+# sayGlobal() without a template
+PLAIN_MESSAGE = Message_Template('{message}')
+
+
+class Outbound_Builder:
+    """Builds RCon command packets from byte segments.
+    Repeated segments are encoded once and kept in a bounded LRU, and the packet's CRC32 is computed by running
+    zlib.crc32 over the segments in turn, so nothing is joined or re-encoded just to checksum it."""
+
+    def __init__(self, cache_entries: int = 1024, say_limit_bytes: int = SAY_LIMIT_BYTES):
+        self.cache_entries = cache_entries
+        self.say_limit_bytes = say_limit_bytes
+        self.segments = OrderedDict()   # text -> UTF-8 bytes, least recently used first
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def encode(self, text: str) -> bytes:
+        """UTF-8 bytes of a segment that is likely to come back, from the cache if possible."""
+
+        segment = self.segments.get(text)
+        if segment is not None:
+            self.segments.move_to_end(text)
+            self.hits += 1
+            return segment
+
+        self.misses += 1
+        segment = self.segments[text] = text.encode('utf-8', 'replace')
+        if len(self.segments) > self.cache_entries: self.segments.popitem(last=False)
+        return segment
+
+    def render(self, template: Message_Template, values: dict) -> list:
+        """The template's segments as bytes, with the values filled in."""
+
+        parts = []
+        for part in template.parts:
+            if type(part) is bytes:
+                parts.append(part)
+            elif part in template.cached:
+                parts.append(self.encode(str(values[part])))
+            else:
+                parts.append(str(values[part]).encode('utf-8', 'replace'))
+        return parts
+
+    @staticmethod
+    def truncate(parts: list, limit_bytes: int) -> list:
+        """Cut the segments to limit_bytes in total, never in the middle of a UTF-8 character."""
+
+        if sum(map(len, parts)) <= limit_bytes: return parts
+
+        kept, total = [], 0
+        for part in parts:
+            if total + len(part) <= limit_bytes:
+                kept.append(part)
+                total += len(part)
+                continue
+
+            cut = limit_bytes - total
+            while cut > 0 and part[cut] & 0xC0 == 0x80: cut -= 1  # back off from a continuation byte
+            if cut: kept.append(part[:cut])
+            break
+        return kept
+
+    @staticmethod
+    def command_packet(parts: list, sequence: int = 0) -> bytes:
+        """A command packet whose command is the concatenation of parts."""
+
+        header = COMMAND_PREFIX + bytes([sequence])
+        crc = zlib.crc32(header)
+        for part in parts: crc = zlib.crc32(part, crc)
+        return b'BE' + struct.pack('<I', crc) + header + b''.join(parts)
+
+    def say_parts(self, player: int, template: Message_Template, values: dict) -> list:
+        """Segments of a Say command to player (-1 for everyone) with the rendered template, cut to the chat limit."""
+
+        return [self.encode(f'Say {player} ')] + self.truncate(
+            self.render(template, values), self.say_limit_bytes)
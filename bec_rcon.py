@@ -3,13 +3,16 @@ import re
 import zlib
 import asyncio
 import traceback
-from collections import deque
+from collections import deque, namedtuple
 import datetime
-import codecs
 import inspect
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+from bec_history import Message_History
+from bec_outbound import Outbound_Builder, PLAIN_MESSAGE, SAY_LIMIT_BYTES
+import struct
+import time
 
 # Author: Yoshi_E
 # Date: 2019.06.14
@@ -19,40 +22,169 @@ import os
 # License: https://creativecommons.org/licenses/by-nc-sa/4.0/
 
 
-log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s(%(lineno)d) %(message)s')
-logFile = os.path.dirname(os.path.realpath(__file__)) + "/bec_rcon.log"
-my_handler = RotatingFileHandler(logFile, mode='a', maxBytes=1 * 1000000, backupCount=10, encoding=None, delay=0)
-my_handler.setFormatter(log_formatter)
-my_handler.setLevel(logging.INFO)
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
-log.addHandler(my_handler)
+my_handler = None
+
+
+# Attaches the rotating bec_rcon.log handler. Done on first use rather than at import,
+# so importing this module stays cheap and does not touch the disk.
+def setupFileLogging():
+    global my_handler
+    if my_handler is not None:
+        return
+    log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s(%(lineno)d) %(message)s')
+    logFile = os.path.dirname(os.path.realpath(__file__)) + "/bec_rcon.log"
+    my_handler = RotatingFileHandler(logFile, mode='a', maxBytes=1 * 1000000, backupCount=10, encoding=None, delay=True)
+    my_handler.setFormatter(log_formatter)
+    my_handler.setLevel(logging.INFO)
+    log.addHandler(my_handler)
+
+
+# Largest datagram a UDP socket can deliver
+MAX_DATAGRAM = 65536
+
+# The acknowledgement of a server message only depends on its sequence number, so all 256 are built once up front
+ACK_PACKETS = [
+    b'BE' + struct.pack('<I', zlib.crc32(bytes([0xFF, 0x02, sequence]))) + bytes([0xFF, 0x02, sequence])
+    for sequence in range(256)]
+
+# Outcome of one command sent with ARC.commandBatch(). error holds the exception if the command failed
+Command_Result = namedtuple('Command_Result', ['command', 'response', 'error'])
+
+
+# Raised instead of sending a command while the circuit breaker considers the server unreachable
+class Circuit_Open_Error(Exception):
+    pass
+
+
+# Tracks recent command failures of one connection, so that commands fail at once while the server is down
+# instead of each waiting out the full timeout.
+#   closed:    commands go through; failureThreshold failures in a row open the circuit
+#   open:      commands fail immediately with Circuit_Open_Error until resetTimeoutSec has passed
+#   half-open: a single command is let through as a probe; its outcome closes or reopens the circuit
+class Circuit_Breaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failureThreshold=3, resetTimeoutSec=10, probeTimeoutSec=30):
+        self.failureThreshold = failureThreshold
+        self.resetTimeoutSec = resetTimeoutSec
+        # a probe that never reports back (e.g. its caller was cancelled) is replaced after this long
+        self.probeTimeoutSec = probeTimeoutSec
+        self.state = self.CLOSED
+        self.failures = 0
+        self.openedAt = 0.0
+        self.probeStartedAt = None
+
+    # True while commands would be turned away. Does not change the state
+    def blocked(self):
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            return now - self.openedAt < self.resetTimeoutSec
+        if self.state == self.HALF_OPEN:
+            return self.probeStartedAt is not None and now - self.probeStartedAt < self.probeTimeoutSec
+        return False
+
+    # Asks to send a command. In the half-open state only the first caller gets through, as the probe
+    def allow(self):
+        if self.blocked():
+            return False
+        if self.state != self.CLOSED:
+            self.state = self.HALF_OPEN
+            self.probeStartedAt = time.monotonic()
+            log.info("[rcon] Circuit half-open, probing the server")
+        return True
+
+    # Seconds until the next probe is let through
+    def retryIn(self):
+        if self.state == self.OPEN:
+            return max(0.0, self.resetTimeoutSec - (time.monotonic() - self.openedAt))
+        if self.state == self.HALF_OPEN and self.probeStartedAt is not None:
+            return max(0.0, self.probeTimeoutSec - (time.monotonic() - self.probeStartedAt))
+        return 0.0
+
+    def recordSuccess(self):
+        if self.state != self.CLOSED:
+            log.info("[rcon] Circuit closed, server reachable again")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probeStartedAt = None
+
+    def recordFailure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failureThreshold:
+            if self.state != self.OPEN:
+                log.info("[rcon] Circuit open after %d failures" % self.failures)
+            self.state = self.OPEN
+            self.openedAt = time.monotonic()
+            self.probeStartedAt = None
+
+    # Raises Circuit_Open_Error unless a command may be sent now
+    def check(self, command: str, probe=True):
+        if (self.allow() if probe else not self.blocked()):
+            return
+        raise Circuit_Open_Error(
+            "Server unreachable, not sending '%s'. Retrying in %.0fs" % (command, self.retryIn()))
 
 
 # noinspection PyPep8Naming
 class ARC:
 
-    def __init__(self, serverIP: str, RConPassword: str, serverPort=2302, options={}):
+    def __init__(self, serverIP: str, RConPassword: str, serverPort=2302, options={}, loop=None):
 
         self.listenForDataTask = None
         self.keepAliveLoopTask = None
         self.options = {
             'timeoutSec': 25,
             'autosaveBans': False,
+            'capturePath': None,  # records all traffic from the first login packet on, to a new file each time
+            'autoConnect': True,  # connect in the constructor; set False and await open() to connect later
+            'slowCallbackSec': 0.1,  # event handlers running longer than this get logged
+            'pipelineWindow': 16,  # commands commandBatch() keeps in flight at once, 1 disables pipelining
+            'recvBufferBytes': 1024 * 1024,  # SO_RCVBUF of the socket, None keeps the OS default
+            'recvBatch': 64,  # most datagrams taken from the socket per wakeup
+            'recvArenaBytes': 256 * 1024,  # preallocated receive buffer shared by a batch of datagrams
+            'serverMessageHistory': 100,  # server messages kept in serverMessage
+            'serverMessageHistoryBytes': None,  # cap on their total text size, None for no cap
+            'commandHistory': 1000,  # command answers kept in serverCommandData
+            'commandHistoryBytes': 1024 * 1024,
+            'circuitFailures': 3,  # failed commands in a row before commands fail fast
+            'circuitResetSec': 10,  # how long commands fail fast before a probe is let through
+            'sayLimitBytes': SAY_LIMIT_BYTES,  # Say messages are cut to this many UTF-8 bytes
             'debug': 50  # See https://docs.python.org/3/library/logging.html#levels
         }
 
+        # Loop the connection's tasks run on. None means the loop that is running when connect() is called
+        self.loop = loop
+
         self.codec = "iso-8859-1"  # "iso-8859-1" #text encoding (not all codings are supported)
 
         self.socket = None
         # Status of the connection
         self.disconnected = True
-        # Stores all recent server message (Format: array([datetime, msg],...))
-        self.serverMessage = deque(maxlen=100)
+        # Server messages received since the login as (sequence, crc32 of body), to spot resends (Format: deque([seq, crc],...))
+        self.serverMessageWindow = deque(maxlen=64)
         # Event Handlers (Format: array([name, function],...)
         self.Events = []
-        # Multi packet buffer
-        self.MultiPackets = []
+        # Multi packet buffers of command answers (Format: {sequence: {packet index: data}})
+        self.MultiPackets = {}
+        # Receive path counters, see getReceiveStats()
+        self.receiveStats = {
+            'datagrams': 0,  # datagrams received
+            'bytes': 0,  # bytes received
+            'wakeups': 0,  # times the receive loop woke up to drain the socket
+            'largestBatch': 0,  # most datagrams drained in one wakeup
+            'overruns': 0,  # wakeups that stopped at recvBatch/recvArenaBytes and left datagrams waiting
+            'malformed': 0,  # datagrams thrown away because they could not be decoded
+            # datagrams the OS dropped because the socket buffer was full, None where it does not tell (not Linux)
+            'kernelDrops': 0 if os.path.exists('/proc/net/udp') else None,
+            'socketBufferBytes': None,  # SO_RCVBUF as granted by the OS
+        }
+        # Futures of pipelined commands waiting for their answer (Format: {sequence: future})
+        self.pendingCommands = {}
+        self.commandSequence = 0
 
         self.lastSend = datetime.datetime.now()
         self.lastReceived = datetime.datetime.now()
@@ -63,11 +195,41 @@ class ARC:
         self.activeSend = 0
         # limits how many data packages can be sent at the same time
         self.max_waiting_for_send = 10
-        # Stores all recent command returned data (Format: array([datetime, msg],...))
-        self.serverCommandData = deque(maxlen=1000)
+        # commands other than background ones waiting for the send lock; background commands give way to them
+        self.foregroundWaiting = 0
         # denotes if the object is getting destroyed
         self.terminated = False
+        # Writes every datagram to a capture file while set (see startRecording)
+        self.recorder = None
+        # Resolved by the login packet while open() waits for it
+        self.loginResult = None
+
+        self.setTarget(serverIP, RConPassword, serverPort)
+        self.options = {**self.options, **options}
+        self.checkOptionTypes()
+        # Stores all recent server messages (see bec_history.Message_History, read with a cursor or iterate)
+        self.serverMessage = Message_History(
+            self.options['serverMessageHistory'], self.options['serverMessageHistoryBytes'])
+        # Stores all recent command returned data (see bec_history.Message_History)
+        self.serverCommandData = Message_History(
+            self.options['commandHistory'], self.options['commandHistoryBytes'])
+        # Encodes and checksums outbound commands, caching names and prefixes that are sent again and again
+        self.outbound = Outbound_Builder(say_limit_bytes=self.options['sayLimitBytes'])
+        self.circuit = Circuit_Breaker(
+            self.options['circuitFailures'], self.options['circuitResetSec'], self.options['timeoutSec'] + 5)
+        setupFileLogging()
+        self.setlogging(self.options["debug"])
+        if self.options['capturePath'] is not None:
+            self.startRecording(self.options['capturePath'])
+        if self.options['autoConnect']:
+            self.connect()
 
+    def setlogging(self, level):
+        level = int(level)
+        log.setLevel(level)
+
+    # Sets the server to log in to. Takes effect on the next connect()
+    def setTarget(self, serverIP: str, RConPassword: str, serverPort=2302):
         if type(serverPort) != int or type(RConPassword) != str or type(serverIP) != str:
             raise Exception('Wrong constructor parameter type(s)!')
         if serverIP == "localhost":  # localhost is not supported
@@ -76,25 +238,45 @@ class ARC:
             self.serverIP = serverIP
         self.serverPort = serverPort
         self.rconPassword = RConPassword
-        self.options = {**self.options, **options}
-        self.checkOptionTypes()
-        self.connect()
-        self.setlogging(self.options["debug"])
-
-    def setlogging(self, level):
-        level = int(level)
-        log.setLevel(level)
 
     # destructor
     def __del__(self):
         self.terminated = True
         self.disconnect()
+        self.stopRecording()
+
+    # Starts writing every inbound and outbound datagram to a capture file, see bec_capture.py
+    def startRecording(self, path: str):
+        import bec_capture
+        self.stopRecording()
+        self.recorder = bec_capture.Capture_Recorder(path)
+        log.info("[rcon] Recording traffic to " + self.recorder.path)
+        return self.recorder
+
+    # Stops the capture started by startRecording()
+    def stopRecording(self):
+        if self.recorder is None:
+            return
+        self.recorder.close()
+        self.recorder = None
 
     # Closes the connection
     def disconnect(self):
         if self.disconnected:
             return None
         log.info("[rcon] Disconnected")
+        # stop waiting on the socket before closing it, so the loop does not keep watching a dead descriptor,
+        # and stop the keepalive, since connect() right after this would never let it see the disconnect
+        try:
+            currentTask = asyncio.current_task()
+        except RuntimeError:  # not called from the loop, e.g. from __del__
+            currentTask = None
+        for task in (self.listenForDataTask, self.keepAliveLoopTask):
+            if task is not None and task is not currentTask:
+                task.cancel()
+        # the drop counter belongs to the socket, keep its count before it goes
+        if self.receiveStats['kernelDrops'] is not None:
+            self.receiveStats['kernelDrops'] += self.socketDrops() or 0
         self.socket.close()
         self.socket = None
         self.disconnected = True
@@ -105,18 +287,45 @@ class ARC:
         self.sendLock = False
         if not self.disconnected:
             self.disconnect()
+        # BattlEye numbers the server messages of every login from 0 again, so earlier ones are no resends
+        self.serverMessageWindow.clear()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  #
         self.socket.connect((self.serverIP, self.serverPort))  # #"udp://"+
         if not self.socket:
             raise Exception('Failed to create socket!')
 
         self.socket.setblocking(bool(0))
+        if self.options['recvBufferBytes']:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.options['recvBufferBytes'])
+        self.receiveStats['socketBufferBytes'] = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
         self.authorize()
         self.disconnected = False
 
         # spawn async tasks
-        self.listenForDataTask = asyncio.ensure_future(self.listenForData())
-        self.keepAliveLoopTask = asyncio.ensure_future(self.keepAliveLoop())
+        self.listenForDataTask = self.getLoop().create_task(self.listenForData())
+        self.keepAliveLoopTask = self.getLoop().create_task(self.keepAliveLoop())
+
+    # Connects and waits for the server to answer the login. Returns True if the login was accepted.
+    async def open(self):
+        self.loginResult = self.getLoop().create_future()
+        self.connect()
+        try:
+            loggedIn = await asyncio.wait_for(asyncio.shield(self.loginResult), self.options['timeoutSec'])
+        except asyncio.TimeoutError:
+            log.info("[rcon] No answer to login")
+            self.circuit.recordFailure()
+            self.disconnect()
+            return False
+        finally:
+            self.loginResult = None
+        self.circuit.recordSuccess()  # any answer, even to a wrong password, means the server is up
+        return loggedIn
+
+    # Returns the loop given to the constructor, or binds to the current one on first use
+    def getLoop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return self.loop
 
     # Closes the current connection and creates a new one
     def reconnect(self):
@@ -129,8 +338,35 @@ class ARC:
     def checkOptionTypes(self):
         if type(self.options['timeoutSec']) != int:
             raise Exception("Expected option 'timeoutSec' to be integer, got %s" % type(self.options['timeoutSec']))
+        if type(self.options['autoConnect']) != bool:
+            raise Exception("Expected option 'autoConnect' to be boolean, got %s" % type(self.options['autoConnect']))
         if type(self.options['autosaveBans']) != bool:
             raise Exception("Expected option 'autosaveBans' to be boolean, got %s" % type(self.options['autosaveBans']))
+        if self.options['capturePath'] is not None and type(self.options['capturePath']) != str:
+            raise Exception("Expected option 'capturePath' to be string, got %s" % type(self.options['capturePath']))
+        if type(self.options['slowCallbackSec']) not in (int, float):
+            raise Exception("Expected option 'slowCallbackSec' to be a number, got %s" % type(self.options['slowCallbackSec']))
+        if type(self.options['pipelineWindow']) != int or not 0 < self.options['pipelineWindow'] < 256:
+            raise Exception("Expected option 'pipelineWindow' to be an integer from 1 to 255, got %r" % self.options['pipelineWindow'])
+        if self.options['recvBufferBytes'] is not None and type(self.options['recvBufferBytes']) != int:
+            raise Exception("Expected option 'recvBufferBytes' to be integer, got %s" % type(self.options['recvBufferBytes']))
+        if type(self.options['recvBatch']) != int or self.options['recvBatch'] < 1:
+            raise Exception("Expected option 'recvBatch' to be a positive integer, got %r" % self.options['recvBatch'])
+        if type(self.options['recvArenaBytes']) != int or self.options['recvArenaBytes'] < MAX_DATAGRAM:
+            raise Exception("Expected option 'recvArenaBytes' to be an integer of at least %d, got %r" % (
+                MAX_DATAGRAM, self.options['recvArenaBytes']))
+        for option in ['serverMessageHistory', 'commandHistory']:
+            if type(self.options[option]) != int or self.options[option] < 1:
+                raise Exception("Expected option '%s' to be a positive integer, got %r" % (option, self.options[option]))
+        for option in ['serverMessageHistoryBytes', 'commandHistoryBytes']:
+            if self.options[option] is not None and type(self.options[option]) != int:
+                raise Exception("Expected option '%s' to be integer, got %s" % (option, type(self.options[option])))
+        if type(self.options['circuitFailures']) != int or self.options['circuitFailures'] < 1:
+            raise Exception("Expected option 'circuitFailures' to be a positive integer, got %r" % self.options['circuitFailures'])
+        if type(self.options['circuitResetSec']) not in (int, float):
+            raise Exception("Expected option 'circuitResetSec' to be a number, got %s" % type(self.options['circuitResetSec']))
+        if type(self.options['sayLimitBytes']) != int or self.options['sayLimitBytes'] < 1:
+            raise Exception("Expected option 'sayLimitBytes' to be a positive integer, got %r" % self.options['sayLimitBytes'])
         if type(self.options['debug']) != int:
             raise Exception("Expected option 'debug' to be boolean, got %s" % type(self.options['debug']))
 
@@ -141,39 +377,157 @@ class ARC:
             raise Exception('Failed to send login!')
 
     # sends the RCon command, but waits until command is confirmed before sending another one
-    async def send(self, command: str):
+    # While the circuit breaker is open it raises Circuit_Open_Error right away instead
+    # parts are the command already encoded in segments (see bec_outbound); command then only names it in errors
+    # background commands (e.g. scheduled broadcasts) only take the connection while no other command is waiting for it
+    async def send(self, command: str, parts=None, background=False):
         # command = command.encode('utf-8', "replace").decode('utf-8', "replace")
+        self.circuit.check(command, probe=False)
         self.activeSend += 1
-        for i in range(0, 10 * self.options['timeoutSec']):
-            if self.activeSend > self.max_waiting_for_send:
-                break
-            if not self.sendLock:  # Lock released by waitForResponse()
-                self.sendLock = True
-                if self.disconnected:
-                    raise Exception('Failed to send command, because the connection is closed!')
-                msgCRC = self.getMsgCRC(command)
-                head = 'BE' + chr(int(msgCRC[0], 16)) + chr(int(msgCRC[1], 16)) + chr(int(msgCRC[2], 16)) + chr(
-                    int(msgCRC[3], 16)) + chr(int('ff', 16)) + chr(int('01', 16)) + chr(int('0', 16))
-                if not self.writeToSocket(head, command):
-                    raise Exception('Failed to send command!')
-                self.activeSend -= 1
-                return True
-            else:
-                await asyncio.sleep(0.1)  # waits 0.1 second before checking again
+        if not background:
+            self.foregroundWaiting += 1
+        try:
+            for i in range(0, 10 * self.options['timeoutSec']):
+                if self.activeSend > self.max_waiting_for_send:
+                    break
+                if not self.sendLock and not (background and self.foregroundWaiting):  # Lock released by waitForResponse()
+                    try:
+                        # the server may have gone down while this command waited for the lock
+                        self.circuit.check(command)
+                    except Circuit_Open_Error:
+                        self.activeSend -= 1
+                        raise
+                    self.sendLock = True
+                    if self.disconnected:
+                        self.activeSend -= 1
+                        self.sendLock = False
+                        self.circuit.recordFailure()
+                        raise Exception('Failed to send command, because the connection is closed!')
+                    # parts of an earlier answer that never completed would otherwise be glued onto this one
+                    self.MultiPackets.pop(0, None)
+                    if parts is None:
+                        parts = [command.encode("utf-8", 'replace')]
+                    try:
+                        # e.g. ConnectionRefusedError once the OS has heard the server is gone
+                        if not self.writePacket(self.outbound.command_packet(parts)):
+                            raise Exception('Failed to send command!')
+                    except Exception:
+                        self.activeSend -= 1
+                        self.sendLock = False
+                        self.circuit.recordFailure()
+                        raise
+                    self.activeSend -= 1
+                    return True
+                else:
+                    await asyncio.sleep(0.1)  # waits 0.1 second before checking again
+        finally:
+            if not background:
+                self.foregroundWaiting -= 1
         self.activeSend -= 1
         if self.activeSend > self.max_waiting_for_send:
             raise Exception(
                 "Failed to send in time: " + command + " too many commands in queue >" + str(self.max_waiting_for_send))
         else:
-            self.sendLock = False
+            # a background command gave way to others; the lock is theirs, not stuck
+            if not background:
+                self.sendLock = False
             raise Exception("Failed to send in time: " + command)
 
+    # Waits until no other command holds the connection, then takes it
+    async def acquireSendLock(self, what: str):
+        self.foregroundWaiting += 1
+        try:
+            for i in range(0, 10 * self.options['timeoutSec']):
+                if not self.sendLock:
+                    self.sendLock = True
+                    return
+                await asyncio.sleep(0.1)
+        finally:
+            self.foregroundWaiting -= 1
+        raise Exception("Failed to send in time: " + what)
+
+    # Sends many commands in one go and gathers every answer. The commands are pipelined: up to
+    # options['pipelineWindow'] of them are in flight at once, each under its own sequence number,
+    # so the batch costs about one round trip instead of one per command.
+    # A command is a string, or (command, parts) with the command already encoded in segments, e.g. from sayCommand()
+    # Returns a Command_Result per command, in order. A failing command does not raise, check its error
+    async def commandBatch(self, commands: list):
+        if not commands:
+            return []
+        results = [None] * len(commands)
+        self.circuit.check("batch of %d commands" % len(commands), probe=False)
+        await self.acquireSendLock("batch of %d commands" % len(commands))
+        try:
+            self.circuit.check("batch of %d commands" % len(commands))
+        except Circuit_Open_Error:
+            self.sendLock = False
+            raise
+        try:
+            window = asyncio.Semaphore(self.options['pipelineWindow'])
+
+            async def run(index, command):
+                async with window:
+                    if isinstance(command, tuple):
+                        results[index] = await self.sendSequenced(*command)
+                    else:
+                        results[index] = await self.sendSequenced(command)
+
+            await asyncio.gather(*(run(index, command) for index, command in enumerate(commands)))
+        finally:
+            self.sendLock = False
+
+        # Nothing came back at all: treat it like a timed out single command
+        if all(isinstance(result.error, asyncio.TimeoutError) for result in results):
+            log.info("[rcon] Failed to keep connection - Disconnected")
+            self.circuit.recordFailure()
+            self.on_command_fail()
+            self.disconnect()
+        elif any(result.error is None for result in results):
+            self.circuit.recordSuccess()
+        else:
+            self.circuit.recordFailure()
+        return results
+
+    # Sends one command under its own sequence number and waits for the answer to that sequence
+    # parts: see send()
+    async def sendSequenced(self, command: str, parts=None):
+        sequence = self.nextSequence()
+        future = self.getLoop().create_future()
+        self.pendingCommands[sequence] = future
+        try:
+            if self.disconnected:
+                raise Exception('Failed to send command, because the connection is closed!')
+            if parts is None:
+                parts = [command.encode("utf-8", 'replace')]
+            if not self.writePacket(self.outbound.command_packet(parts, sequence)):
+                raise Exception('Failed to send command!')
+            return Command_Result(command, await asyncio.wait_for(future, self.options['timeoutSec']), None)
+        except Exception as e:
+            return Command_Result(command, None, e)
+        finally:
+            self.pendingCommands.pop(sequence, None)
+            self.MultiPackets.pop(sequence, None)
+
+    # Next free sequence number for a pipelined command. 0 is left to send(), whose answers go to waitForResponse()
+    def nextSequence(self):
+        for i in range(0, 255):
+            self.commandSequence = self.commandSequence % 255 + 1
+            if self.commandSequence not in self.pendingCommands:
+                return self.commandSequence
+        raise Exception('No free sequence number, too many commands in flight')
+
     # Writes the given message to the socket
     def writeToSocket(self, head, command=""):
-        self.lastSend = datetime.datetime.now()
         a = bytes(head.encode(self.codec, 'replace'))
         b = bytes.fromhex(command.encode("utf-8", 'replace').hex())
-        return self.socket.send(a + b)
+        return self.writePacket(a + b)
+
+    # Writes an already encoded packet to the socket
+    def writePacket(self, packet: bytes):
+        self.lastSend = datetime.datetime.now()
+        if self.recorder is not None:
+            self.recorder.outbound(packet)
+        return self.socket.send(packet)
 
     # Debug function to view special chars
     def String2Hex(self, string):
@@ -228,16 +582,26 @@ class ARC:
         await self.send("Kick " + str(player) + " " + reason)
         return await self.waitForResponse()
 
-    # Sends a global message to all players
-    async def sayGlobal(self, message: str):
-        await self.send("Say -1 " + message)
-        return await self.waitForResponse()
+    # Sends a global message to all players. background: see send()
+    async def sayGlobal(self, message: str, background=False):
+        return await self.sayTemplate(-1, PLAIN_MESSAGE, background, message=message)
 
     # Sends a message to a specific player
     async def sayPlayer(self, player: int, message: str):
-        await self.send("Say " + str(player) + " " + message)
+        return await self.sayTemplate(player, PLAIN_MESSAGE, message=message)
+
+    # Sends a message built from a bec_outbound.Message_Template to a player, -1 for everyone.
+    # The message is cut to options['sayLimitBytes']
+    async def sayTemplate(self, player: int, template, background=False, **values):
+        await self.send("Say %s %s" % (player, template.template), self.outbound.say_parts(player, template, values),
+                        background)
         return await self.waitForResponse()
 
+    # The Say command of sayTemplate() as (command, parts), to send with commandBatch()
+    def sayCommand(self, player: int, template, **values):
+        parts = self.outbound.say_parts(player, template, values)
+        return b''.join(parts).decode("utf-8", 'replace'), parts
+
     # Loads the "scripts.txt" file without the need to restart the server
     async def loadScripts(self):
         await self.send('loadScripts')
@@ -265,7 +629,10 @@ class ARC:
 
     # Gets a list of all players currently on the server as an array
     async def getPlayersArray(self):
-        playersRaw = await self.getPlayers()
+        return self.parsePlayers(await self.getPlayers())
+
+    # Turns the answer to 'players' into an array
+    def parsePlayers(self, playersRaw):
         players = self.cleanList(playersRaw)
         playerstr = re.findall(
             r"(\d+)\s+(\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}:\d+\b)\s+(\d+)\s+([\da-fA-F]+)\(\w+\)\s([\S ]+)", players)
@@ -324,6 +691,15 @@ class ARC:
             await self.writeBans()
         return await self.waitForResponse()
 
+    # addBan for many GUIDs at once, pipelined. bans: iterable of (guid, reason, time)
+    # Returns a Command_Result per ban
+    async def addBans(self, bans):
+        results = await self.commandBatch(
+            ["addBan " + str(guid) + " " + str(time) + " " + reason for guid, reason, time in bans])
+        if self.options['autosaveBans']:
+            await self.writeBans()
+        return results
+
     # Removes a ban
     async def removeBan(self, banId: int):
         await self.send("removeBan " + str(banId))
@@ -436,15 +812,20 @@ class ARC:
             if inspect.iscoroutinefunction(func):  # is async
                 if event[0] == parent:
                     if len(args) > 0:
-                        asyncio.ensure_future(func(args))
+                        self.getLoop().create_task(func(args))
                     else:
-                        asyncio.ensure_future(func())
+                        self.getLoop().create_task(func())
             else:
                 if event[0] == parent:
+                    started = time.perf_counter()
                     if len(args) > 0:
                         func(args)
                     else:
                         func()
+                    elapsed = time.perf_counter() - started
+                    if elapsed > self.options['slowCallbackSec']:
+                        log.warning("[rcon] Slow %s handler %s blocked the loop for %.3fs" % (
+                            parent, getattr(func, '__qualname__', func), elapsed))
 
     ###################################################################################################
     #####                                  event functions                                         ####
@@ -454,26 +835,54 @@ class ARC:
         self.check_Event("on_disconnect")
 
     def login_Success(self):
+        if self.loginResult is not None and not self.loginResult.done():
+            self.loginResult.set_result(True)
         self.check_Event("login_Success")
 
     def login_fail(self):
+        if self.loginResult is not None and not self.loginResult.done():
+            self.loginResult.set_result(False)
         self.disconnect()
         self.check_Event("login_fail")
 
-    def received_ServerMessage(self, packet, message):
-        self.serverMessage.append([datetime.datetime.now(), message])
-        self.sendReceiveConfirmation(packet[8])  # confirm with sequence id from packet
-        self.check_Event("received_ServerMessage", message)
+    # Called after the message was acknowledged, see handlePacket(). body is the raw UTF-8 text
+    def received_ServerMessage(self, sequence: int, body: bytes):
+        # BattlEye sends a message again when our ack got lost; it was acknowledged again, but is only passed on once
+        key = [sequence, zlib.crc32(body)]
+        if key in self.serverMessageWindow:
+            log.debug("[rcon] Ignoring resent server message %d" % sequence)
+            return
+        self.serverMessageWindow.append(key)
+        self.serverMessage.append(body)
+        # only decode the text if someone is listening
+        if any(event[0] == "received_ServerMessage" for event in self.Events):
+            self.check_Event("received_ServerMessage", body.decode("utf-8", "replace"))
 
     # waitForResponse() handles all inbound packets, you can still fetch them here though.
-    def received_CommandMessage(self, packet, message):
-        if len(message) > 3 and self.String2Hex(message[0]) == "00":  # is multi packet
-            self.MultiPackets.append(message[3:])
-            if int(self.String2Hex(message[1]), 16) - 1 == int(self.String2Hex(message[2]), 16):
-                self.serverCommandData.append([datetime.datetime.now(), "".join(self.MultiPackets)])
-                self.MultiPackets = []
-        else:  # Normal Package
-            self.serverCommandData.append([datetime.datetime.now(), message])
+    # Answers to pipelined commands go to the commandBatch() waiting for their sequence instead.
+    def received_CommandMessage(self, packet: bytes):
+        sequence = packet[8]
+        body = packet[9:]
+        # Only send() uses sequence 0. Any other sequence nobody waits for is the late answer of a pipelined command
+        # that timed out; it must not be taken for the answer of the next send()
+        if sequence != 0 and sequence not in self.pendingCommands:
+            log.info("[rcon] Dropping late answer to command sequence %d" % sequence)
+            return
+        if len(body) > 3 and body[0] == 0:  # is multi packet: 0x00, packet count, packet index, data
+            parts = self.MultiPackets.setdefault(sequence, {})
+            parts[body[2]] = body[3:]
+            if len(parts) < body[1]:
+                return
+            body = b"".join(parts[index] for index in sorted(parts))
+            del self.MultiPackets[sequence]
+        message = body.decode("utf-8", "replace")
+
+        future = self.pendingCommands.get(sequence)
+        if future is not None:
+            if not future.done():
+                future.set_result(message)
+        elif sequence == 0:
+            self.serverCommandData.append(body)
         self.check_Event("received_CommandMessage", message)
 
     def on_command_fail(self):
@@ -484,72 +893,124 @@ class ARC:
     ###################################################################################################
     # returns when a new command package was received
     async def waitForResponse(self):
-        d = len(self.serverCommandData)
+        cursor = self.serverCommandData.cursor()
         timeout = self.options['timeoutSec'] * 20  # 10 = one second
         for i in range(0, timeout):
-            if d < len(self.serverCommandData):  # new command package was received
+            if cursor < self.serverCommandData.cursor():  # new command package was received
                 self.sendLock = False  # release the lock
-                data = self.serverCommandData.pop()[1]
-                if len(self.serverCommandData) >= self.serverCommandData.maxlen / 2:
-                    self.serverCommandData.clear()
-                return data
+                self.circuit.recordSuccess()
+                return self.serverCommandData.get(cursor)[1]
             await asyncio.sleep(0.05)
         log.info("[rcon] Failed to keep connection - Disconnected")
+        self.circuit.recordFailure()
         self.on_command_fail()
         self.sendLock = False
         self.disconnect()  # Connection Lost
         raise Exception("Command timed out")
 
-    def sendReceiveConfirmation(self, sequence):
+    # Acknowledges the server message with the given sequence number
+    def sendReceiveConfirmation(self, sequence: int):
         if self.disconnected:
             raise Exception('Failed to send command, because the connection is closed!')
+        if not self.writePacket(ACK_PACKETS[sequence]):
+            raise Exception('Failed to send confirmation!')
 
-        # calculate CRC32
-        sequencestr = bytes((chr(255) + chr(2) + sequence).encode(self.codec))
-        msgCRC = ('%x' % zlib.crc32(sequencestr)).zfill(8)
-        msgCRC = [msgCRC[-2:], msgCRC[-4:-2], msgCRC[-6:-4], msgCRC[0:2]]
+    # Checks a single datagram and dispatches it to the matching event function.
+    # Server messages are acknowledged straight from the raw header, before anything is decoded, so a busy loop
+    # does not make BattlEye resend them; decoding and dispatch follow on the next loop iteration.
+    def handlePacket(self, data: bytes):
+        if len(data) < 9 or data[:2] != b'BE' or data[6] != 0xFF:
+            raise Exception('Malformed packet: %r' % data[:16])
+        if zlib.crc32(memoryview(data)[6:]) != struct.unpack_from('<I', data, 2)[0]:
+            raise Exception('Checksum mismatch, dropping packet')
 
-        # generate send message
-        msg = 'BE' + chr(int(msgCRC[0], 16)) + chr(int(msgCRC[1], 16)) + chr(int(msgCRC[2], 16)) + chr(
-            int(msgCRC[3], 16)) + chr(int('ff', 16)) + chr(int("02", 16)) + sequence
-        if not self.writeToSocket(msg):
-            raise Exception('Failed to send confirmation!')
+        packet_type = data[7]
+        self.lastReceived = datetime.datetime.now()
+        log.debug("[rcon] Received Package type: {:02x}".format(packet_type))
+        if packet_type == 0x02:
+            self.sendReceiveConfirmation(data[8])
+            self.getLoop().call_soon(self.received_ServerMessage, data[8], data[9:])
+        if packet_type == 0x01:
+            self.received_CommandMessage(data)
+        if packet_type == 0x00:  # "Login packet"
+            if data[-1] == 0:  # Raise error when login failed
+                self.login_fail()
+                raise Exception('Login failed, wrong password or wrong port!')
+            else:
+                self.login_Success()
 
+    # Sleeps until a datagram arrives, then drains every datagram already waiting into one preallocated buffer
+    # before decoding any of them, so bursts leave the socket buffer as fast as possible
     async def listenForData(self):
+        loop = self.getLoop()
+        arena = memoryview(bytearray(self.options['recvArenaBytes']))
+        stats = self.receiveStats
         while not self.disconnected:
-            answer = ""
             try:
-                answer = self.socket.recv(102400).decode(self.codec)
-                header = answer[:7]
-                crc32_checksum = header[2:-1]
-
-                body = "" + self.String2Hex(answer[9:])
-                body = codecs.decode(body, "hex", errors="strict")  #
-                body = body.decode(encoding="utf-8",
-                                   errors='replace')  # some encoding magic (iso-8859-1(with utf-8 chars) --> utf-8)
-
-                packet_type = self.String2Hex(answer[7])
-                self.lastReceived = datetime.datetime.now()
-                log.debug("[rcon] Received Package type: {}".format(packet_type))
-                log.debug("[rcon] Data: {}".format(body))
-                if packet_type == "02":
-                    self.received_ServerMessage(answer, body)
-                if packet_type == "01":
-                    self.received_CommandMessage(answer, body)
-                if packet_type == "00":  # "Login packet"
-                    if ord(answer[len(answer) - 1]) == 0:  # Raise error when login failed
-                        self.login_fail()
-                        raise Exception('Login failed, wrong password or wrong port!')
-                    else:
-                        self.login_Success()
+                ends = [await loop.sock_recv_into(self.socket, arena)]
+                while len(ends) < self.options['recvBatch'] and len(arena) - ends[-1] >= MAX_DATAGRAM:
+                    try:
+                        ends.append(ends[-1] + self.socket.recv_into(arena[ends[-1]:]))
+                    except BlockingIOError:  # drained
+                        break
+                else:
+                    # the batch is full; only an overrun if it really left something behind for the next wakeup
+                    try:
+                        self.socket.recv(1, socket.MSG_PEEK)
+                        stats['overruns'] += 1
+                    except BlockingIOError:
+                        pass
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                if type(e) != BlockingIOError:  # ignore "no data received" error
+                log.error(traceback.format_exc())
+                print(e)
+                print('disconnected in listenForData')
+                self.disconnect()
+                break
+
+            stats['wakeups'] += 1
+            stats['datagrams'] += len(ends)
+            stats['bytes'] += ends[-1]
+            stats['largestBatch'] = max(stats['largestBatch'], len(ends))
+
+            start = 0
+            for end in ends:
+                data = bytes(arena[start:end])
+                start = end
+                if self.recorder is not None:
+                    self.recorder.inbound(data)
+                if self.disconnected:  # e.g. the login failed earlier in this batch
+                    break
+                try:
+                    self.handlePacket(data)
+                except Exception:
+                    stats['malformed'] += 1
                     log.error(traceback.format_exc())
-                    print(e)
-                    print('disconnected in listenForData')
-                    self.disconnect()
-            if answer == "":
-                await asyncio.sleep(0.2)
+
+    # Returns a copy of the receive path counters
+    def getReceiveStats(self):
+        stats = dict(self.receiveStats)
+        if stats['kernelDrops'] is not None:
+            stats['kernelDrops'] += self.socketDrops() or 0
+        return stats
+
+    # Datagrams the kernel dropped for the current socket because its receive buffer was full, from the drops
+    # column of /proc/net/udp. None without a real socket (e.g. bec_capture.Replay_ARC) or where that table does not exist
+    def socketDrops(self):
+        if self.socket is None:
+            return None
+        try:
+            inode = str(os.fstat(self.socket.fileno()).st_ino)
+            with open('/proc/net/udp') as udp_table:
+                next(udp_table)  # column names
+                for line in udp_table:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return int(fields[-1])
+        except (OSError, AttributeError, ValueError, IndexError, StopIteration):
+            return None
+        return None
 
     async def keepAliveLoop(self):
         while not self.disconnected:
@@ -565,6 +1026,8 @@ class ARC:
         try:
             log.debug('[rcon] --Keep connection alive--' + "\n")
             await self.getBEServerVersion()
+        except Circuit_Open_Error:
+            return False  # not sent at all, so it says nothing new about the connection
         except Exception as e:
             log.debug("[rcon] Failed to keep Alive - Disconnected")
             print('disconnected in keepalive')
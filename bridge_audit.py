@@ -0,0 +1,178 @@
+import asyncio
+import json
+import os
+import time
+from array import array
+from collections import deque
+
+AUDIT_PATH = os.path.join('resources', 'audit.log')
+
+
+class Batched_Writer:
+    """Appends lines to a file from a background task, in batches.
+    write() only queues the line. The writer task waits batch_window_s for more lines to arrive, then hands the whole
+    batch to an executor thread that appends it with a single write (and fsync, if asked), so a burst of records costs
+    one disk flush instead of one each and the loop never waits for the disk."""
+
+    def __init__(self, path: str, fsync: bool = True, batch_window_s: float = 0.05):
+        self.path = path
+        self.fsync = fsync
+        self.batch_window_s = batch_window_s
+        self.pending = []          # lines waiting for the next batch
+        self.pending_ready = None
+        self.writer_task = None
+        self.batches = 0
+        return
+
+    def start(self):
+        if self.writer_task is None:
+            self.pending_ready = asyncio.Event()
+            if self.pending: self.pending_ready.set()
+            self.writer_task = asyncio.ensure_future(self.writer())
+        return self
+
+    def write(self, line: str):
+        self.pending.append(line)
+        if self.pending_ready is not None: self.pending_ready.set()
+
+    async def writer(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.pending_ready.wait()
+            await asyncio.sleep(self.batch_window_s)  # let the rest of a burst join this batch
+            self.pending_ready.clear()
+
+            batch, self.pending = self.pending, []
+            try:
+                offset = await loop.run_in_executor(None, self.append, batch)
+            except OSError as e:
+                # Keep the lines for the next attempt rather than losing them.
+                print(f'Unable to write {self.path}, retrying: {e}')
+                self.pending[:0] = batch
+                await asyncio.sleep(5)
+                self.pending_ready.set()
+                continue
+            self.written(batch, offset)
+
+    def append(self, batch: list) -> int:
+        """Append the lines with one write. Returns the file offset of the first. Blocking."""
+
+        directory = os.path.dirname(self.path)
+        if directory: os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'ab') as log_file:
+            offset = log_file.tell()
+            log_file.write(''.join(batch).encode('utf8'))
+            log_file.flush()
+            if self.fsync: os.fsync(log_file.fileno())
+        self.batches += 1
+        return offset
+
+    def written(self, batch: list, offset: int):
+        """Called on the loop once a batch is on disk."""
+        return
+
+    def flush(self):
+        """Write whatever is queued right away, e.g. on shutdown. Blocking."""
+
+        batch, self.pending = self.pending, []
+        if batch: self.written(batch, self.append(batch))
+
+
+class Audit_Log(Batched_Writer):
+    """Append-only log of moderation actions, one JSON object per line, with in-memory indexes of the file offsets
+    of every record by target GUID and by actor, so the history of a player or moderator is a handful of reads."""
+
+    def __init__(self, path: str = AUDIT_PATH):
+        super().__init__(path, fsync=True)
+        self.by_guid = dict()     # lowercase guid -> array of file offsets
+        self.by_actor = dict()    # actor id -> array of file offsets
+        self.records_pending = deque()   # records queued but not yet on disk, in the order of their lines
+        self.indexed = None
+        return
+
+    def start(self):
+        """Index the existing log in an executor, then start the writer. Records made meanwhile wait in the queue."""
+
+        if self.indexed is None:
+            self.indexed = asyncio.Event()
+            asyncio.ensure_future(self.load_index())
+        return self
+
+    async def load_index(self):
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.scan)
+        finally:
+            self.indexed.set()
+            super().start()
+
+    def scan(self):
+        if not os.path.exists(self.path): return
+        with open(self.path, 'r+b') as log_file:
+            offset = 0
+            for line in log_file:
+                if not line.endswith(b'\n'):
+                    # The last line was torn by a crash. Cut it off, so the next record starts on a line of its own.
+                    log_file.truncate(offset)
+                    break
+                try:
+                    self.index(json.loads(line), offset)
+                except ValueError:
+                    pass
+                offset += len(line)
+
+    def index(self, record: dict, offset: int):
+        if record.get("guid"): self.by_guid.setdefault(record["guid"].lower(), array('Q')).append(offset)
+        if record.get("actor_id") is not None: self.by_actor.setdefault(str(record["actor_id"]), array('Q')).append(offset)
+
+    def record(self, action: str, actor, guid: str = None, target: str = None, reason: str = None, duration: int = None,
+               result: str = 'ok', latency_s: float = None, **details):
+        """Queue a record of one action. actor is the discord user who ordered it."""
+
+        record = {
+            "time": time.time(),
+            "action": action,
+            "actor": str(actor),
+            "actor_id": getattr(actor, 'id', None),
+            "guid": guid,
+            "target": target,
+            "reason": reason,
+            "duration": duration,
+            "result": result,
+            "latency_ms": round(latency_s * 1000, 1) if latency_s is not None else None,
+            **details,
+        }
+        self.records_pending.append(record)
+        self.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return record
+
+    def written(self, batch: list, offset: int):
+        for line in batch:
+            self.index(self.records_pending.popleft(), offset)
+            offset += len(line.encode('utf8'))
+
+    def read_at(self, offsets) -> list:
+        """Records at the given file offsets. Blocking."""
+
+        records = []
+        with open(self.path, 'rb') as log_file:
+            for offset in offsets:
+                log_file.seek(offset)
+                records.append(json.loads(log_file.readline()))
+        return records
+
+    async def history(self, guid: str = None, actor_id=None, limit: int = 10) -> list:
+        """The last limit records about a player (by GUID) or by a moderator (by actor id), oldest first,
+        including those still waiting to be written."""
+
+        if self.indexed is not None: await self.indexed.wait()
+
+        if guid is not None:
+            offsets = self.by_guid.get(guid.lower(), ())
+            pending = [record for record in self.records_pending if (record["guid"] or '').lower() == guid.lower()]
+        else:
+            offsets = self.by_actor.get(str(actor_id), ())
+            pending = [record for record in self.records_pending if str(record["actor_id"]) == str(actor_id)]
+
+        offsets = list(offsets[-(limit - len(pending)):]) if len(pending) < limit else []
+        records = await asyncio.get_event_loop().run_in_executor(None, self.read_at, offsets) if offsets else []
+        return (records + pending)[-limit:]
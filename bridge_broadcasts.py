@@ -0,0 +1,190 @@
+import asyncio
+import datetime
+import json
+import os
+import bec_fleet
+from bridge_files import atomic_write
+
+LORE_PATH = os.path.join('resources', 'bec_server_lore.json')
+SCHEDULE_PATH = os.path.join('resources', 'bec_broadcasts.json')
+# Where each library's rotation has got to, kept apart from the lore file so running the bot leaves that alone.
+STATE_PATH = os.path.join('resources', 'bec_broadcasts_state.json')
+
+# (lowest, highest) of the five cron fields: minute, hour, day of the month, month, day of the week (0 and 7 = Sunday)
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+class Cron_Schedule:
+    """A standard five field cron expression such as '*/30 * * * *' or '0 6,18 * * 1-5', in the bot's local time.
+    Fields take *, numbers, ranges (a-b), steps (*/n, a-b/n) and lists of those."""
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5: raise ValueError(f'Cron expression {expression!r} does not have 5 fields')
+
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parse_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS))
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+
+        # As in cron, a restricted day of the month and day of the week match when either does.
+        self.any_day, self.any_weekday = fields[2] == '*', fields[4] == '*'
+        return
+
+    @staticmethod
+    def parse_field(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            else:
+                start, _, end = part.partition('-')
+                start = int(start)
+                end = int(end) if end else (high if step else start)
+            step = int(step) if step else 1
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f'Cron field {field!r} is outside {low}-{high}')
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches(self, moment: datetime.datetime) -> bool:
+        if moment.minute not in self.minutes or moment.hour not in self.hours or moment.month not in self.months:
+            return False
+
+        day_matches = moment.day in self.days
+        weekday_matches = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday: return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+
+class Broadcast_Library:
+    """A rotation of messages, sent one after the other. index is the next one to go out."""
+
+    def __init__(self, name: str, messages: list, index: int = 0):
+        if not messages: raise ValueError(f'Library {name!r} has no messages')
+        self.name = name
+        self.messages = messages
+        self.index = index % len(messages)
+        return
+
+    def next_message(self) -> str:
+        message = self.messages[self.index]
+        self.index = (self.index + 1) % len(self.messages)
+        return message
+
+
+class Broadcast:
+    """One entry of the schedule file. Either
+      {"name": ..., "cron": "*/30 * * * *", "message": "..."} or "library": "<name>" instead of a message,
+    or a countdown to the times the cron expression names, with a warning the given minutes before each:
+      {"name": ..., "cron": "0 */4 * * *", "countdown_min": [30, 10, 1], "message": "Restart in {minutes} minutes"}"""
+
+    def __init__(self, entry: dict, libraries: dict):
+        self.name = entry.get("name") or entry.get("library") or entry["cron"]
+        self.cron = Cron_Schedule(entry["cron"])
+        self.message = entry.get("message")
+        self.library = libraries[entry["library"]] if entry.get("library") else None
+        self.countdown_min = sorted(int(minutes) for minutes in entry.get("countdown_min", ()))
+        if (self.message is None) == (self.library is None):
+            raise ValueError(f'Broadcast {self.name!r} needs either a message or a library')
+        if self.countdown_min and self.message is None:
+            raise ValueError(f'Countdown {self.name!r} needs a message')
+        return
+
+    def due(self, minute: datetime.datetime) -> list:
+        """Messages to send at this minute."""
+
+        if self.countdown_min:
+            return [self.message.format(minutes=minutes) for minutes in self.countdown_min
+                    if self.cron.matches(minute + datetime.timedelta(minutes=minutes))]
+        if not self.cron.matches(minute): return []
+        return [self.library.next_message() if self.library is not None else self.message]
+
+
+class Broadcast_Scheduler:
+    """Sends scheduled global messages to every managed server over the bridge's own RCON connections.
+    The schedule and the message libraries are read once, at start(). Broadcasts are sent as background commands,
+    so they wait for moderation and other commands rather than delaying them. The library rotation is saved to
+    state_path, so a restart carries on where it left off; the index in the lore file is only where a library starts."""
+
+    def __init__(self, clients, lore_path: str = LORE_PATH, schedule_path: str = SCHEDULE_PATH,
+                 state_path: str = STATE_PATH):
+        """clients returns the {alias: ARC} to broadcast to, e.g. Server_Bridge.managed_clients."""
+
+        self.clients = clients
+        self.lore_path = lore_path
+        self.schedule_path = schedule_path
+        self.state_path = state_path
+        self.libraries = dict()     # name -> Broadcast_Library
+        self.broadcasts = []
+        self.broadcast_task = None
+        self.send_tasks = set()     # broadcasts on their way, kept so they finish and their errors are seen
+        return
+
+    def load(self):
+        """Read the libraries and the schedule. Raises ValueError or OSError if either is unusable."""
+
+        if os.path.exists(self.lore_path):
+            with open(self.lore_path, encoding='utf8') as lore_file:
+                lore = json.load(lore_file)
+            indexes = dict()
+            if os.path.exists(self.state_path):
+                with open(self.state_path, encoding='utf8') as state_file:
+                    indexes = json.load(state_file)
+            self.libraries = {name: Broadcast_Library(name, entry["library"], indexes.get(name, entry.get("index", 0)))
+                              for name, entry in lore.items() if isinstance(entry, dict) and "library" in entry}
+
+        if os.path.exists(self.schedule_path):
+            with open(self.schedule_path, encoding='utf8') as schedule_file:
+                entries = json.load(schedule_file).get("broadcasts", [])
+            try:
+                self.broadcasts = [Broadcast(entry, self.libraries) for entry in entries]
+            except KeyError as e:
+                raise ValueError(f'{self.schedule_path}: missing or unknown {e}')
+
+    def start(self):
+        if self.broadcast_task is not None: return
+        try:
+            self.load()
+        except (ValueError, OSError) as e:
+            print(f'Scheduled broadcasts disabled: {e}')
+            return
+        if self.broadcasts: self.broadcast_task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            # Wake just after each minute starts, and act for that minute.
+            now = datetime.datetime.now()
+            await asyncio.sleep(60 - now.second - now.microsecond / 1e6 + 0.5)
+            minute = datetime.datetime.now().replace(second=0, microsecond=0)
+
+            rotated = False
+            for broadcast in self.broadcasts:
+                for message in broadcast.due(minute):
+                    send_task = asyncio.ensure_future(self.send(broadcast.name, message))
+                    self.send_tasks.add(send_task)
+                    send_task.add_done_callback(self.sent)
+                    rotated = rotated or broadcast.library is not None
+
+            if rotated:
+                try:
+                    await asyncio.get_event_loop().run_in_executor(None, self.save_indexes)
+                except OSError as e:
+                    print(f'Unable to save the broadcast rotation: {e}')
+
+    async def send(self, name: str, message: str):
+        results = await bec_fleet.fleet_say(self.clients(), message, background=True)
+        for alias, result in results.items():
+            if result.error is not None: print(f'Broadcast {name} to {alias} failed: {result.error}')
+
+    def sent(self, send_task: asyncio.Future):
+        self.send_tasks.discard(send_task)
+        if not send_task.cancelled() and send_task.exception() is not None:
+            print(f'Broadcast failed: {send_task.exception()!r}')
+
+    def save_indexes(self):
+        """Write the libraries' rotation to the state file, swapping it in whole. Blocking."""
+
+        indexes = {name: library.index for name, library in self.libraries.items()}
+        atomic_write(self.state_path, json.dumps(indexes).encode('utf8'))
@@ -0,0 +1,154 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+from bridge_files import atomic_write
+
+CONFIG_PATH = os.path.join('resources', 'bec_server_config.json')
+
+# key: (accepted type, required)
+CONFIG_SCHEMA = {
+    "guild_alias": (str, False),
+    "guild_id": (int, True),
+    "bec_server_ipv4": (str, True),
+    "bec_rcon_port": (int, True),
+    "bec_rcon_password": (str, True),
+    "guild_debug_channel": (int, True),
+    "guild_dayz_channel": (int, True),
+    "guild_moderation_channel": (int, True),
+    "maximum_reconnect_attempts": (int, False),
+    "reconnect_attempt_interval_s": (float, False),
+    "capture_path": (str, False),
+    "snapshot_interval_s": (float, False),
+}
+
+CONFIG_DEFAULTS = {
+    "maximum_reconnect_attempts": 100,
+    "reconnect_attempt_interval_s": 60,
+    "snapshot_interval_s": 15,
+}
+
+# Changing any of these means the ARC has to log in again.
+CONNECTION_KEYS = ("bec_server_ipv4", "bec_rcon_port", "bec_rcon_password")
+
+log = logging.getLogger(__name__)
+
+
+class Config_Error(Exception):
+    """Raised when a configuration does not pass validation."""
+
+
+class Config_Service:
+    """Owns the bridge configuration file.
+    Validates every change, writes it atomically and tells the subscribers, so nothing needs a restart."""
+
+    def __init__(self, path: str = CONFIG_PATH):
+        self.path = path
+        self.config = None
+        self.subscribers = []
+        self.loaded_mtime_ns = None
+        return
+
+    @staticmethod
+    def validate(config: dict) -> dict:
+        """Return a normalized copy of config, or raise Config_Error describing every problem found.
+        Keys unknown to the schema are kept as they are."""
+
+        problems = []
+        validated = {**CONFIG_DEFAULTS, **config}
+
+        for key, (expected_type, required) in CONFIG_SCHEMA.items():
+            if key not in validated or validated[key] is None:
+                if required: problems.append(f'{key} is missing')
+                continue
+
+            value = validated[key]
+            try:
+                # Discord ids and ports often arrive as strings, from the command line or a hand edited file.
+                if expected_type is int and type(value) != bool: value = int(value)
+                elif expected_type is float and type(value) != bool: value = float(value)
+                elif type(value) != expected_type: raise ValueError()
+            except (TypeError, ValueError):
+                problems.append(f'{key} should be {expected_type.__name__}, got {value!r}')
+                continue
+            validated[key] = value
+
+        if not problems:
+            if not 0 < validated["bec_rcon_port"] < 65536:
+                problems.append(f'bec_rcon_port {validated["bec_rcon_port"]} is not a valid port')
+            if validated["maximum_reconnect_attempts"] < 0:
+                problems.append('maximum_reconnect_attempts cannot be negative')
+            if validated["reconnect_attempt_interval_s"] <= 0:
+                problems.append('reconnect_attempt_interval_s must be positive')
+            if validated["snapshot_interval_s"] <= 0:
+                problems.append('snapshot_interval_s must be positive')
+
+        if problems: raise Config_Error('Invalid configuration: ' + '; '.join(problems))
+        return validated
+
+    def read(self):
+        """Read and validate the config file without applying it. Returns None if it does not exist yet."""
+
+        if not os.path.exists(self.path): return None
+
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        with open(self.path, encoding='utf8') as json_file:
+            config = self.validate(json.load(json_file))
+        self.loaded_mtime_ns = mtime_ns
+        return config
+
+    def load(self):
+        """Read the config file and make it the current config."""
+
+        self.config = self.read()
+        return self.config
+
+    def write(self, config: dict):
+        """Write the config next to the real file, then swap it in, so a crash never leaves half a file behind."""
+
+        atomic_write(self.path, json.dumps(config, indent=4).encode('utf8'))
+        self.loaded_mtime_ns = os.stat(self.path).st_mtime_ns
+        return
+
+    def subscribe(self, callback):
+        """callback(old_config, new_config) is called after every accepted change. It may be a coroutine function."""
+        self.subscribers.append(callback)
+
+    async def update(self, changes: dict, replace: bool = False) -> dict:
+        """Merge changes into the current config (or replace it entirely), validate, write and notify."""
+
+        new_config = self.validate(dict(changes) if replace or self.config is None else {**self.config, **changes})
+        self.write(new_config)
+        await self.apply(new_config)
+        return new_config
+
+    async def apply(self, new_config: dict):
+        old_config, self.config = self.config, new_config
+        if old_config == new_config: return
+
+        for callback in self.subscribers:
+            try:
+                if inspect.iscoroutinefunction(callback):
+                    await callback(old_config, new_config)
+                else:
+                    callback(old_config, new_config)
+            except Exception:
+                log.exception('Config subscriber failed')
+        return
+
+    async def watch(self, interval_s: float = 5):
+        """Pick up edits made to the file by hand. Invalid edits are logged and ignored."""
+
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                if not os.path.exists(self.path): continue
+                if os.stat(self.path).st_mtime_ns == self.loaded_mtime_ns: continue
+
+                await self.apply(self.read())
+                print(f'Reloaded {self.path}')
+            except (Config_Error, ValueError, OSError) as e:
+                # Do not try the same broken file again until it changes.
+                self.loaded_mtime_ns = os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else None
+                print(f'Ignoring changes to {self.path}: {e}')
@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+
+def atomic_write(path: str, data: bytes):
+    """Replace the file at path with data, all at once.
+    data goes to a temporary file in the same directory, is flushed to disk, and only then swapped in with
+    os.replace, so a crash leaves either the old file or the new one, never half of one. Blocking."""
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}-')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temporary_file:
+            temporary_file.write(data)
+            temporary_file.flush()
+            os.fsync(temporary_file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path): os.remove(temporary_path)
+        raise
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+log = logging.getLogger(__name__)
+
+LOOP_BACKENDS = ('auto', 'uvloop', 'asyncio')
+
+
+def new_event_loop(backend: str = 'auto'):
+    """Create the loop the whole bot runs on and make it the current loop.
+    'auto' uses uvloop when it is installed, 'uvloop' insists on it, 'asyncio' always uses the default loop.
+    Returns (loop, name of the backend actually used)."""
+
+    if backend not in LOOP_BACKENDS:
+        raise ValueError(f'Unknown event loop backend {backend!r}, expected one of {", ".join(LOOP_BACKENDS)}')
+
+    loop, name = None, 'asyncio'
+    if backend != 'asyncio':
+        try:
+            import uvloop
+            loop, name = uvloop.new_event_loop(), 'uvloop'
+        except ImportError:
+            if backend == 'uvloop': raise
+            log.info('uvloop is not installed, using the default asyncio loop')
+
+    if loop is None: loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop, name
+
+
+class Slow_Callback_Watchdog:
+    """Logs whatever is blocking the loop for longer than threshold_s.
+
+    A ticker on the loop stamps the time every tick_s. A watchdog thread checks the stamp, and when it goes
+    stale it logs the loop thread's current stack, which names the handler that is hogging the loop.
+    Works on any loop backend, unlike asyncio's debug mode, and costs one tiny callback per tick."""
+
+    def __init__(self, loop, threshold_s: float = 0.1, tick_s: float = None):
+        self.loop = loop
+        self.threshold_s = threshold_s
+        self.tick_s = tick_s if tick_s is not None else threshold_s / 2
+        self.last_tick = time.monotonic()
+        self.loop_thread_id = None
+        self.stalls = 0
+        self.stopped = threading.Event()
+        self.ticker_task = None
+        self.thread = None
+        return
+
+    def start(self):
+        self.ticker_task = self.loop.create_task(self.ticker())
+        self.thread = threading.Thread(target=self.watch, name='slow-callback-watchdog', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.ticker_task is not None: self.ticker_task.cancel()
+        return
+
+    async def ticker(self):
+        self.loop_thread_id = threading.get_ident()
+        while True:
+            self.last_tick = time.monotonic()
+            await asyncio.sleep(self.tick_s)
+
+    def watch(self):
+        reported_tick = None
+        while not self.stopped.wait(self.tick_s):
+            last_tick = self.last_tick
+            blocked_s = time.monotonic() - last_tick - self.tick_s
+
+            # Report each stall once, while it is still happening, so the stack is the culprit's.
+            if blocked_s < self.threshold_s or last_tick == reported_tick or self.loop_thread_id is None: continue
+            reported_tick = last_tick
+            self.stalls += 1
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else '(stack unavailable)\n'
+            log.warning(f'Event loop blocked for {blocked_s:.3f}s+ in:\n{stack}')
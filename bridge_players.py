@@ -0,0 +1,201 @@
+import re
+import time
+
+GUID_PATTERN = re.compile(r'^[\da-fA-F]{32}$')
+IP_PATTERN = re.compile(r'^(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(:\d+)?$')
+
+# Scores of the different kinds of name matches; trigram matches scale below TRIGRAM_SCORE by similarity.
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.9
+SUBSTRING_SCORE = 0.8
+TRIGRAM_SCORE = 0.7
+MIN_TRIGRAM_SIMILARITY = 0.3
+ONLINE_BONUS = 0.05
+
+
+def trigrams(text: str) -> set:
+    """Trigrams of a lowercased name, padded so short names and name starts still produce some."""
+
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Player_Record:
+    """One player the bridge has seen, on the server right now or recently."""
+
+    __slots__ = ('guid', 'name', 'name_key', 'ip', 'player_id', 'lifetime_id', 'online', 'last_seen')
+
+    def __init__(self, guid: str, name: str, ip: str, player_id: str, lifetime_id: str):
+        self.guid = guid
+        self.name = name
+        self.name_key = name.lower()
+        self.ip = ip
+        self.player_id = player_id
+        self.lifetime_id = lifetime_id
+        self.online = True
+        self.last_seen = time.time()
+
+    def as_dict(self) -> dict:
+        """The fields shown to moderators, in the order of the old kick/ban embeds."""
+        return {
+            "Name": self.name,
+            "IP Address": self.ip,
+            "BattleEye ID": self.guid,
+            "Server Lifetime ID": self.lifetime_id,
+            "Server Instance ID": self.player_id,
+        }
+
+
+class Player_Index:
+    """Search index over the current roster and the most recent max_recent players who left.
+    Names are found by prefix, substring and trigram similarity; GUIDs and IPs by exact lookup."""
+
+    def __init__(self, max_recent: int = 500):
+        self.max_recent = max_recent
+        self.by_guid = dict()       # guid (lowercase) -> Player_Record
+        self.by_ip = dict()         # ip without port -> set of guids
+        self.by_trigram = dict()    # trigram -> set of guids
+        return
+
+    def __len__(self):
+        return len(self.by_guid)
+
+    def get(self, guid: str):
+        return self.by_guid.get(guid.lower())
+
+    def online(self) -> list:
+        return [record for record in self.by_guid.values() if record.online]
+
+    def update_roster(self, player_list: list):
+        """Replace the roster with the output of ARC.getPlayersArray().
+        Returns (joined, left) lists of Player_Record compared to the previous roster."""
+
+        now = time.time()
+        previously_online = {guid for guid, record in self.by_guid.items() if record.online}
+        joined = []
+
+        # [pid, ip:port, lifetime id, BE GUID, name]
+        for player_id, address, lifetime_id, guid, name in player_list:
+            key = guid.lower()
+            name = re.sub(r'\s*\(Lobby\)$', '', name)
+            record = self.by_guid.get(key)
+
+            if record is None or record.name != name or record.ip != address.split(':')[0]:
+                if record is not None: self.remove(key)
+                record = Player_Record(guid, name, address.split(':')[0], player_id, lifetime_id)
+                self.add(key, record)
+            record.player_id, record.lifetime_id = player_id, lifetime_id
+            record.last_seen = now
+
+            if key not in previously_online: joined.append(record)
+            record.online = True
+            previously_online.discard(key)
+
+        left = []
+        for key in previously_online:
+            self.by_guid[key].online = False
+            left.append(self.by_guid[key])
+
+        self.evict()
+        return joined, left
+
+    def add(self, key: str, record: Player_Record):
+        self.by_guid[key] = record
+        self.by_ip.setdefault(record.ip, set()).add(key)
+        for trigram in trigrams(record.name_key): self.by_trigram.setdefault(trigram, set()).add(key)
+
+    def remove(self, key: str):
+        record = self.by_guid.pop(key)
+        self.discard_from(self.by_ip, record.ip, key)
+        for trigram in trigrams(record.name_key): self.discard_from(self.by_trigram, trigram, key)
+
+    @staticmethod
+    def discard_from(index: dict, bucket, key: str):
+        keys = index.get(bucket)
+        if keys is None: return
+        keys.discard(key)
+        if not keys: del index[bucket]
+
+    def evict(self):
+        """Forget the players who left longest ago, beyond max_recent."""
+
+        offline = [record for record in self.by_guid.values() if not record.online]
+        if len(offline) <= self.max_recent: return
+        offline.sort(key=lambda record: record.last_seen)
+        for record in offline[:len(offline) - self.max_recent]: self.remove(record.guid.lower())
+
+    def to_snapshot(self) -> list:
+        """Every record as a plain list, for bridge_snapshot."""
+        return [[record.guid, record.name, record.ip, record.player_id, record.lifetime_id, record.online,
+                 record.last_seen] for record in self.by_guid.values()]
+
+    def load_snapshot(self, rows: list):
+        """Restore records saved by to_snapshot(). The next update_roster() then only reports
+        the players who actually joined or left since the snapshot."""
+
+        for guid, name, ip, player_id, lifetime_id, online, last_seen in rows:
+            key = guid.lower()
+            if key in self.by_guid: self.remove(key)
+            record = Player_Record(guid, name, ip, player_id, lifetime_id)
+            record.online, record.last_seen = online, last_seen
+            self.add(key, record)
+        self.evict()
+
+    def search(self, query: str, limit: int = 5) -> list:
+        """Return up to limit (score, Player_Record) pairs, best first. Online players win ties."""
+
+        query = query.strip()
+        if not query: return []
+
+        if GUID_PATTERN.match(query):
+            record = self.by_guid.get(query.lower())
+            return [(EXACT_SCORE, record)] if record is not None else []
+
+        ip_match = IP_PATTERN.match(query)
+        if ip_match:
+            return self.rank([(EXACT_SCORE, self.by_guid[key]) for key in self.by_ip.get(ip_match.group(1), ())], limit)
+
+        query_key = query.lower()
+        query_trigrams = trigrams(query_key)
+
+        # Count shared trigrams per candidate. A name containing a query of three or more characters shares
+        # at least one unpadded trigram with it, so prefix and substring matches are always among the candidates.
+        # Shorter queries have no unpadded trigram, and are checked against every name instead.
+        shared = dict()
+        if len(query_key) < 3:
+            shared = {key: 0 for key, record in self.by_guid.items() if query_key in record.name_key}
+        for trigram in query_trigrams:
+            for key in self.by_trigram.get(trigram, ()):
+                shared[key] = shared.get(key, 0) + 1
+
+        scored = []
+        for key, shared_count in shared.items():
+            record = self.by_guid[key]
+            if record.name_key == query_key: score = EXACT_SCORE
+            elif record.name_key.startswith(query_key): score = PREFIX_SCORE
+            elif query_key in record.name_key: score = SUBSTRING_SCORE
+            else:
+                # Share of the query found in the name; long names are not penalized for their length.
+                similarity = shared_count / len(query_trigrams)
+                if similarity < MIN_TRIGRAM_SIMILARITY: continue
+                score = TRIGRAM_SCORE * similarity
+            scored.append((score, record))
+
+        return self.rank(scored, limit)
+
+    @staticmethod
+    def rank(scored: list, limit: int) -> list:
+        scored.sort(key=lambda pair: (pair[0] + (ONLINE_BONUS if pair[1].online else 0), pair[1].last_seen), reverse=True)
+        return scored[:limit]
+
+    def resolve(self, query: str, limit: int = 5):
+        """Return (record, candidates). record is set when the query clearly names one player:
+        an exact GUID, IP or name, or a single candidate. Otherwise the moderator picks from candidates."""
+
+        candidates = self.search(query, limit)
+        if not candidates: return None, candidates
+        if len(candidates) == 1: return candidates[0][1], candidates
+
+        exact = [record for score, record in candidates if score == EXACT_SCORE]
+        if len(exact) == 1: return exact[0], candidates
+        return None, candidates
@@ -0,0 +1,149 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Hot spots of the bridge the CPU report always breaks out, whether or not they make the top N.
+FOCUS_FUNCTIONS = (
+    'listenForData',
+    'handlePacket',
+    'received_ServerMessage',
+    'check_Event',
+    'parse_message_rcon_to_discord',
+    'parse_message_discord_to_rcon',
+    'discord_sender',
+)
+
+# Leaf functions that mean the loop is waiting for work rather than doing any.
+IDLE_FUNCTIONS = ('select', 'poll', 'epoll', '_run_once')
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class Sampling_Profiler:
+    """Samples the stack of one thread (the event loop's) from a background thread.
+    Cheap enough to run against the live bot: the loop itself does no extra work.
+    A sample is only taken when the sampler gets the GIL, so work done in stretches shorter than
+    sys.getswitchinterval() shows up less than it should; look at the totals over a long enough run."""
+
+    def __init__(self, thread_id: int = None, interval_s: float = 0.005):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval_s = interval_s
+        self.stacks = Counter()       # 'outer;...;inner' -> samples
+        self.samples = 0
+        self.started = None
+        self.elapsed_s = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+        return
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.sample, name='bridge-profiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None: self.thread.join()
+        self.elapsed_s = time.perf_counter() - self.started
+        return self
+
+    def sample(self):
+        while not self.stopped.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: continue
+
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """Stacks in the collapsed format flamegraph.pl and speedscope read."""
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common()) + '\n'
+
+    def report(self, top_n: int = 25) -> str:
+        """Plain text summary: idle share, the bridge's hot spots, then the top functions by own and total time."""
+
+        own, total, focus = Counter(), Counter(), Counter()
+        idle = 0
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            if frames[-1].rsplit(':', 1)[-1] in IDLE_FUNCTIONS: idle += count
+            for label in set(frames):
+                total[label] += count
+                if label.rsplit(':', 1)[-1] in FOCUS_FUNCTIONS: focus[label] += count
+
+        samples = max(self.samples, 1)
+        percent = lambda count: f'{100 * count / samples:6.2f}%'
+        lines = [
+            f'{self.samples} samples over {self.elapsed_s:.1f}s (every {self.interval_s * 1000:.0f} ms)',
+            f'idle (waiting for events): {percent(idle)}',
+            '',
+            'Bridge hot spots (including callees):',
+        ]
+        lines += [f'  {percent(count)}  {label}' for label, count in focus.most_common()] or ['  (not seen)']
+        lines += ['', f'Top {top_n} by own time:']
+        lines += [f'  {percent(count)}  {label}' for label, count in own.most_common(top_n)]
+        lines += ['', f'Top {top_n} by total time:']
+        lines += [f'  {percent(count)}  {label}' for label, count in total.most_common(top_n)]
+        return '\n'.join(lines) + '\n'
+
+
+class Memory_Tracker:
+    """tracemalloc snapshots of the running bot: start() takes a baseline, diff() shows what grew since."""
+
+    def __init__(self, frames: int = 10):
+        self.frames = frames
+        self.baseline = None
+        return
+
+    @property
+    def running(self) -> bool:
+        return self.baseline is not None and tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing(): tracemalloc.start(self.frames)
+        self.baseline = tracemalloc.take_snapshot()
+
+    def stop(self):
+        tracemalloc.stop()
+        self.baseline = None
+
+    @staticmethod
+    def filtered(snapshot):
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+    def diff(self, top_n: int = 25) -> str:
+        """Allocation growth since the baseline, largest first, with the stack of the biggest growers."""
+
+        if self.baseline is None: raise RuntimeError('Memory tracking is not running')
+
+        current = tracemalloc.take_snapshot()
+        traced, peak = tracemalloc.get_traced_memory()
+        statistics = self.filtered(current).compare_to(self.filtered(self.baseline), 'traceback')
+
+        lines = [f'traced memory: {traced / 1e6:.2f} MB (peak {peak / 1e6:.2f} MB)', '',
+                 f'Top {top_n} growths since the baseline:']
+        for statistic in statistics[:top_n]:
+            frame = statistic.traceback[-1] if len(statistic.traceback) else None
+            where = f'{os.path.basename(frame.filename)}:{frame.lineno}' if frame else '?'
+            lines.append(f'  {statistic.size_diff / 1024:+10.1f} KiB  {statistic.count_diff:+7d} blocks  {where}')
+
+        lines += ['', 'Stacks of the top 5:']
+        for statistic in statistics[:5]:
+            lines.append(f'  {statistic.size_diff / 1024:+.1f} KiB')
+            lines += [f'    {line}' for line in statistic.traceback.format()]
+        return '\n'.join(lines) + '\n'
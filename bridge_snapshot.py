@@ -0,0 +1,73 @@
+import json
+import os
+import struct
+import time
+import zlib
+from bridge_files import atomic_write
+
+SNAPSHOT_PATH = os.path.join('resources', 'bridge_snapshot.bin')
+
+# Snapshot file layout: magic b'BBSN', format version (uint8), crc32 of the body (uint32), then the body,
+# which is zlib compressed JSON. A file that fails the magic, version or checksum is ignored as a whole.
+SNAPSHOT_MAGIC = b'BBSN'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sBI')
+
+
+class Snapshot_Store:
+    """Reads and writes the bridge's warm restart snapshot.
+    Writes go to a temporary file that replaces the old snapshot only once complete, so a crash mid-write
+    leaves the previous snapshot intact."""
+
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path = path
+        self.last_body_crc = None
+        return
+
+    @staticmethod
+    def encode(state: dict) -> bytes:
+        return Snapshot_Store.pack(json.dumps(state, separators=(',', ':')).encode('utf8'))
+
+    @staticmethod
+    def pack(text: bytes) -> bytes:
+        """The file contents for a body of JSON text."""
+
+        body = zlib.compress(text, 6)
+        return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, zlib.crc32(body)) + body
+
+    @staticmethod
+    def decode(data: bytes) -> dict:
+        magic, version, body_crc = SNAPSHOT_HEADER.unpack_from(data)
+        body = data[SNAPSHOT_HEADER.size:]
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or zlib.crc32(body) != body_crc:
+            raise ValueError('not a valid version %d snapshot' % SNAPSHOT_VERSION)
+        return json.loads(zlib.decompress(body).decode('utf8'))
+
+    def write(self, state: dict) -> bool:
+        """Write state unless it is unchanged since the last write. Returns whether anything was written.
+        Blocking; the bridge runs it in an executor."""
+
+        # saved_at is left out of the comparison, so an idle bridge does not rewrite the file. It is put in front
+        # of the serialized state afterwards, so the state is serialized and compressed only once.
+        text = json.dumps({key: value for key, value in state.items() if key != "saved_at"},
+                          separators=(',', ':')).encode('utf8')
+        body_crc = zlib.crc32(text)
+        if body_crc == self.last_body_crc: return False
+
+        saved_at = b'{"saved_at":' + json.dumps(time.time()).encode('ascii')
+        data = self.pack(saved_at + (b',' + text[1:] if text != b'{}' else b'}'))
+
+        atomic_write(self.path, data)
+        self.last_body_crc = body_crc
+        return True
+
+    def read(self):
+        """Return the last snapshot, or None if there is none or it is damaged."""
+
+        if not os.path.exists(self.path): return None
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                return self.decode(snapshot_file.read())
+        except (ValueError, struct.error, zlib.error, OSError) as e:
+            print(f'Ignoring snapshot {self.path}: {e}')
+            return None
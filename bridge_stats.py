@@ -0,0 +1,315 @@
+import asyncio
+import bisect
+import os
+import re
+import struct
+import time
+from array import array
+from bridge_files import atomic_write
+
+STATS_DIRECTORY = os.path.join('resources', 'stats')
+
+# Every tier is a file of fixed width records, one per time bucket, oldest first:
+#   file header: magic b'BBTS', format version (uint8), bucket width in seconds (uint32)
+#   record:      bucket start in unix seconds (uint32), player count samples (uint32), sum of the samples (uint32),
+#                lowest and highest sample (uint16 each), joins and leaves in the bucket (uint32 each)
+# A record cut short by a crash is dropped when the file is next opened.
+# The series are changed in memory on the event loop; their files are written behind them, off the loop.
+STATS_MAGIC = b'BBTS'
+STATS_VERSION = 1
+FILE_HEADER = struct.Struct('<4sBI')
+RECORD = struct.Struct('<IIIHHII')
+
+DAY_S = 86400
+
+# name, bucket width, how long records are kept (None keeps them forever). Minutes roll up into hours, hours into days.
+TIERS = (
+    ('minute', 60, 14 * DAY_S),
+    ('hour', 3600, 400 * DAY_S),
+    ('day', DAY_S, None),
+)
+
+RANGE_PATTERN = re.compile(r'^(\d+)\s*([hdwmy])$')
+RANGE_UNITS = {'h': 3600, 'd': DAY_S, 'w': 7 * DAY_S, 'm': 30 * DAY_S, 'y': 365 * DAY_S}
+
+
+def parse_range(text: str) -> int:
+    """'24h', '7d', '2w', '3m' or '1y' in seconds. Raises ValueError for anything else."""
+
+    match = RANGE_PATTERN.match(text.strip().lower())
+    if match is None or int(match.group(1)) == 0: raise ValueError(f'Unknown range {text!r}, use e.g. 24h, 7d, 2w, 3m or 1y')
+    return int(match.group(1)) * RANGE_UNITS[match.group(2)]
+
+
+def merge(first, second):
+    """Combine two records into one covering both, keeping the start of the first."""
+
+    if first is None: return second
+    return (first[0], first[1] + second[1], first[2] + second[2], min(first[3], second[3]), max(first[4], second[4]),
+            first[5] + second[5], first[6] + second[6])
+
+
+class Rollup_Series:
+    """One tier of the time series: its records in column arrays, searched by bucket start, and its file.
+    Changes only touch the arrays; take_writes() hands what the file is missing to write_file()."""
+
+    def __init__(self, path: str, width_s: int, retention_s: int = None):
+        self.path = path
+        self.width_s = width_s
+        self.retention_s = retention_s
+        self.starts = array('L')
+        self.samples = array('L')
+        self.sums = array('L')
+        self.lows = array('H')
+        self.highs = array('H')
+        self.joins = array('L')
+        self.leaves = array('L')
+        self.columns = (self.starts, self.samples, self.sums, self.lows, self.highs, self.joins, self.leaves)
+        self.unwritten = []     # packed records to append to the file
+        self.rewrite = False    # the whole file has to be written again, e.g. after a trim
+        self.load()
+        return
+
+    def __len__(self):
+        return len(self.starts)
+
+    def load(self):
+        if not os.path.exists(self.path): return
+
+        with open(self.path, 'rb') as series_file:
+            data = series_file.read()
+        try:
+            magic, version, width_s = FILE_HEADER.unpack_from(data)
+        except struct.error:
+            magic, version, width_s = None, None, None
+        if magic != STATS_MAGIC or version != STATS_VERSION or width_s != self.width_s:
+            print(f'Ignoring {self.path}: not a version {STATS_VERSION} series of {self.width_s}s buckets')
+            return
+
+        complete = FILE_HEADER.size + (len(data) - FILE_HEADER.size) // RECORD.size * RECORD.size
+        for record in RECORD.iter_unpack(memoryview(data)[FILE_HEADER.size:complete]):
+            for column, value in zip(self.columns, record): column.append(value)
+
+        # Drop a torn record at the end, so the next append lines up again.
+        if complete != len(data):
+            with open(self.path, 'r+b') as series_file: series_file.truncate(complete)
+
+    def record(self, index: int) -> tuple:
+        return tuple(column[index] for column in self.columns)
+
+    def end(self):
+        """Start of the bucket after the last record, or None if there are no records yet."""
+        return self.starts[-1] + self.width_s if self.starts else None
+
+    def append(self, record: tuple):
+        for column, value in zip(self.columns, record): column.append(value)
+        if not self.rewrite: self.unwritten.append(RECORD.pack(*record))
+
+        # Let a quarter of the retention pile up before rewriting the file, so trimming stays rare.
+        if self.retention_s is not None and record[0] - self.starts[0] > self.retention_s * 1.25:
+            self.trim(record[0] - self.retention_s)
+
+    def trim(self, before: int):
+        """Forget the records of buckets starting before the given time. The file is then rewritten without them."""
+
+        count = bisect.bisect_left(self.starts, before)
+        for column in self.columns: del column[:count]
+        self.rewrite = True
+        self.unwritten = []
+
+    def take_writes(self):
+        """What the file is missing, for write_file(): ('append', packed records), ('rewrite', copies of the columns)
+        or None. Cheap; the arrays are copied, not packed, so the loop can go on changing them."""
+
+        if self.rewrite:
+            self.rewrite = False
+            return 'rewrite', tuple(array(column.typecode, column) for column in self.columns)
+        if self.unwritten:
+            unwritten, self.unwritten = self.unwritten, []
+            return 'append', b''.join(unwritten)
+        return None
+
+    def write_file(self, writes):
+        """Bring the file up to date with writes from take_writes(). Blocking."""
+
+        kind, data = writes
+        header = FILE_HEADER.pack(STATS_MAGIC, STATS_VERSION, self.width_s)
+        if kind == 'rewrite':
+            atomic_write(self.path, header + b''.join(RECORD.pack(*record) for record in zip(*data)))
+            return
+
+        new_file = not os.path.exists(self.path)
+        if new_file: os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'ab') as series_file:
+            if new_file: series_file.write(header)
+            series_file.write(data)
+
+    def between(self, start: int, end: int):
+        """Records of the buckets starting in [start, end)."""
+
+        for index in range(bisect.bisect_left(self.starts, start), bisect.bisect_left(self.starts, end)):
+            yield self.record(index)
+
+    def aggregate(self, start: int, end: int):
+        """All records of the buckets starting in [start, end) merged into one, or None if there are none."""
+
+        merged = None
+        for record in self.between(start, end): merged = merge(merged, record)
+        return merged
+
+
+class Player_Stats:
+    """On-disk time series of the player count and of joins and leaves.
+    Samples are summed up per minute; every finished minute is written to the minute series and rolled up into
+    the hour and day series as those buckets finish. Queries read the coarsest tier that covers the range and the
+    finer tiers for the part the coarse one has not got yet, so they touch at most a few thousand records.
+    Once start()ed, a background task writes the files in an executor; until then they are written as they change."""
+
+    def __init__(self, directory: str = STATS_DIRECTORY):
+        self.directory = directory
+        self.series = [Rollup_Series(os.path.join(directory, f'players_{name}.bin'), width_s, retention_s)
+                       for name, width_s, retention_s in TIERS]
+        self.current = None    # the minute being filled, as a record tuple
+        self.writes_ready = None
+        self.writer_task = None
+        return
+
+    def start(self):
+        if self.writer_task is None:
+            self.writes_ready = asyncio.Event()
+            self.writer_task = asyncio.ensure_future(self.writer())
+        return self
+
+    async def writer(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.writes_ready.wait()
+            self.writes_ready.clear()
+            writes = self.take_writes()
+            try:
+                await loop.run_in_executor(None, self.write_files, writes)
+            except OSError as e:
+                # The arrays are complete; write each file again from them on the next attempt.
+                print(f'Unable to write the player stats, retrying: {e}')
+                for series in self.series: series.rewrite = True
+                await asyncio.sleep(5)
+                self.writes_ready.set()
+
+    def take_writes(self) -> list:
+        return [(series, writes) for series in self.series for writes in (series.take_writes(),) if writes is not None]
+
+    @staticmethod
+    def write_files(writes: list):
+        for series, series_writes in writes: series.write_file(series_writes)
+
+    def record(self, players: int, joins: int = 0, leaves: int = 0, now: float = None):
+        """Add a player count sample, and the joins and leaves seen since the last one."""
+
+        now = int(time.time() if now is None else now)
+        minute = self.series[0]
+        bucket = now - now % minute.width_s
+        players = min(players, 0xFFFF)
+
+        if self.current is not None and self.current[0] != bucket: self.close_minute()
+        self.current = merge(self.current, (bucket, 1, players, players, players, joins, leaves))
+
+    def close_minute(self):
+        self.series[0].append(self.current)
+        self.current = None
+
+        # Roll every finished bucket of a coarser tier up from the tier below. After downtime this catches up on
+        # every bucket the finer tier has records for, so nothing is lost as long as it is still retained there.
+        for finer, coarser in zip(self.series, self.series[1:]):
+            if not finer: break
+            next_start = coarser.end()
+            if next_start is None: next_start = finer.starts[0] - finer.starts[0] % coarser.width_s
+            while next_start + coarser.width_s <= finer.end():
+                rollup = finer.aggregate(next_start, next_start + coarser.width_s)
+                if rollup is not None: coarser.append((next_start,) + rollup[1:])
+                next_start += coarser.width_s
+
+        if self.writes_ready is not None: self.writes_ready.set()
+        else: self.write_files(self.take_writes())
+
+    def flush(self):
+        """Write the minute being filled and everything not on disk yet, e.g. on shutdown. Blocking.
+        The remaining samples of the minute then start a new record."""
+
+        if self.current is not None: self.close_minute()
+        self.write_files(self.take_writes())
+
+    def records(self, start: int, end: int, tier: int = None):
+        """(tier, record) of the records covering [start, end), from the coarsest tier that has them (no coarser than
+        tier, if given), and the minute being filled."""
+
+        yield from self.tier_records(len(self.series) - 1 if tier is None else tier, start, end)
+        if self.current is not None and start <= self.current[0] < end: yield 0, self.current
+
+    def tier_records(self, tier: int, start: int, end: int):
+        """Whole buckets of this tier inside [start, end); the finer tiers fill in the partial bucket at the start
+        and whatever this tier has not rolled up yet at the end."""
+
+        series = self.series[tier]
+        if tier == 0:
+            for record in series.between(start, end): yield tier, record
+            return
+
+        # The partial bucket at the start comes from the finer tier, unless that tier no longer goes back that far.
+        finer = self.series[tier - 1]
+        first = start + (-start) % series.width_s
+        if not finer or finer.starts[0] > start: first = start - start % series.width_s
+        if first >= end:
+            yield from self.tier_records(tier - 1, start, end)
+            return
+        rolled_up = min(max(first, series.end() or first), end)
+
+        yield from self.tier_records(tier - 1, start, first)
+        for record in series.between(first, rolled_up): yield tier, record
+        yield from self.tier_records(tier - 1, rolled_up, end)
+
+    def peak_start(self, tier: int, start: int, peak: int) -> int:
+        """Start of the finest bucket, inside the given bucket of this tier, that still holds the peak."""
+
+        while tier > 0:
+            width_s = self.series[tier].width_s
+            tier -= 1
+            for record in self.series[tier].between(start, start + width_s):
+                if record[4] == peak:
+                    start = record[0]
+                    break
+            else:
+                break
+        return start
+
+    def summary(self, range_s: int, now: float = None) -> dict:
+        """Peak, low and average player count over the last range_s seconds, with joins and leaves,
+        the average per hour of the day (UTC) and the time of the peak.
+        A day record has no hours, so the hours of the day come from the hour tier and finer; they cover as much
+        of the range as the hour tier still keeps."""
+
+        now = int(time.time() if now is None else now)
+        start, end = now - range_s, now + 1
+        total = None
+        peak_tier, peak_record = None, None
+
+        for tier, record in self.records(start, end):
+            if total is None or record[4] > total[4]: peak_tier, peak_record = tier, record
+            total = merge(total, record)
+        if total is None: return None
+
+        by_hour = [[0, 0] for _ in range(24)]    # [sum, samples] per UTC hour of the day
+        for _, record in self.records(start, end, tier=1):
+            hour = by_hour[record[0] // 3600 % 24]
+            hour[0] += record[2]
+            hour[1] += record[1]
+
+        return {
+            "samples": total[1],
+            "average": total[2] / total[1],
+            "low": total[3],
+            "peak": total[4],
+            "peak_at": self.peak_start(peak_tier, peak_record[0], total[4]),
+            "joins": total[5],
+            "leaves": total[6],
+            "hourly_average": [hour_sum / samples if samples else None for hour_sum, samples in by_hour],
+        }
@@ -1,33 +1,99 @@
-import json
 import asyncio
-import os
-from threading import Timer, Event
+import datetime
+import typing
+from collections import deque
 import discord
 from discord.ext import commands
 import bec_rcon
+import bec_fleet
+import bec_outbound
+import bridge_audit
+import bridge_broadcasts
+import bridge_config
+import bridge_players
+import bridge_snapshot
+import bridge_stats
+import io
 import re
+import sys
+import threading
+import time
+import traceback
+
+# How a discord message shows up in game. Names and the source tag repeat, so their encoding is cached.
+RELAY_TEMPLATE = bec_outbound.Message_Template('{username}{source}: {content}', cached=('username', 'source'))
 
 
 class Server_Bridge:
     """Manages the bridge between the dayz and discord servers."""
 
-    def __init__(self, discord_client: discord.Client):
+    def __init__(self, discord_client: discord.Client, bec_client: bec_rcon.ARC = None,
+                 config_service: bridge_config.Config_Service = None):
+        """bec_client replaces the ARC built from the config, e.g. a bec_capture.Replay_ARC for replays."""
 
         # keep a reference to the discord client for handling messages
         self.discord_client = discord_client
         self.reconnect_attempts = 0
+        self.reconnecting = False
+        self.reconnect_task = None
+        self.heartbeat_task = None
+        self.config_watch_task = None
+
+        # Players on the server and those who left recently, searchable by name, GUID and IP.
+        self.player_index = bridge_players.Player_Index()
+
+        # Known bans by lowercase GUID ([ban id, guid, minutes left or perm, reason]), and when they were fetched.
+        self.ban_cache = dict()
+        self.ban_cache_time = 0.0
+
+        # Messages waiting to be delivered to discord, in order, as (channel id, text).
+        self.discord_outbox = deque(maxlen=1000)
+        self.outbox_ready = asyncio.Event()
+        self.discord_sender_task = None
+
+        # Player count, joins and leaves over time, kept on disk for )stats.
+        self.player_stats = bridge_stats.Player_Stats()
+
+        # Every moderation action, written in batches by a background task.
+        self.audit_log = bridge_audit.Audit_Log()
+
+        # Announcements, lore and restart countdowns sent to every managed server on a schedule.
+        self.broadcaster = bridge_broadcasts.Broadcast_Scheduler(self.managed_clients)
 
-        # Load the config file, doing all the path stuff as needed
-        self.bec_config = dict()
-        if not os.path.exists(r'resources'): os.makedirs(r'resources') # Make resources folder if it doesn't exist
-        with open(r"resources\bec_server_config.json", encoding='utf8') as json_file:
-            self.bec_config = json.load(json_file) # load the config file into memory
+        # Bridge state is saved periodically, so a restart picks up where the last run left off.
+        self.snapshot_store = bridge_snapshot.Snapshot_Store()
+        self.snapshot_task = None
+
+        # Load the config file. Until )isc writes one, the bridge idles without an ARC client.
+        self.config_service = config_service if config_service is not None else bridge_config.Config_Service()
+        self.bec_config = self.config_service.load() or dict()
+        self.config_service.subscribe(self.on_config_changed)
 
         # Create the ARC client, which will be the connection between the dayz server and the bot.
-        self.bec_client = bec_rcon.ARC(
+        # It only logs in once start() runs, so that it can do so alongside the discord login.
+        self.bec_client = bec_client
+        if self.bec_client is None and self.bec_config:
+            self.bec_client = self.create_bec_client()
+        elif self.bec_client is not None:
+            self.add_bec_events()
+
+        return
+
+    def create_bec_client(self) -> bec_rcon.ARC:
+        """Build an ARC client from the current config, without connecting it."""
+
+        bec_client = bec_rcon.ARC(
             self.bec_config["bec_server_ipv4"],
             self.bec_config["bec_rcon_password"],
-            self.bec_config["bec_rcon_port"])
+            self.bec_config["bec_rcon_port"],
+            {"capturePath": self.bec_config.get("capture_path"), "autoConnect": False},
+            loop=self.discord_client.loop)
+        self.bec_client = bec_client
+        self.add_bec_events()
+        return bec_client
+
+    def add_bec_events(self):
+        """Route the ARC client's events to the bridge."""
 
         # When the rcon client receives a server message, determine where it goes.
         self.bec_client.add_Event(
@@ -39,40 +105,205 @@ class Server_Bridge:
         # Upon disconnect, try to reconnect in intervals defined by the config file.
         self.bec_client.add_Event(
             "on_disconnect",
-            lambda: asyncio.run_coroutine_threadsafe(
-                self.cycle_reconnect(),
-                self.discord_client.loop))
+            lambda: self.discord_client.loop.call_soon_threadsafe(self.start_reconnect))
+
+        return
+
+    def managed_clients(self) -> dict:
+        """Every dayz server the bridge manages, as {alias: ARC}, for the bec_fleet helpers."""
+
+        if self.bec_client is None: return dict()
+        return {self.bec_config.get("guild_alias") or self.bec_config["bec_server_ipv4"]: self.bec_client}
+
+    async def on_config_changed(self, old_config: dict, new_config: dict):
+        """Apply a new config while running. Channels and reconnect settings are read from bec_config
+        on every use, so only a change of server or credentials needs the ARC client to log in again."""
 
-        # Add heartbeat; clients need to see a signal every 45 seconds, or they close.
-        self.heartbeat()
+        self.bec_config = new_config
+
+        # First configuration since startup: create the connection now.
+        if self.bec_client is None:
+            self.create_bec_client()
+            await self.start()
+            return
+
+        if old_config is not None and all(
+                old_config.get(key) == new_config.get(key) for key in bridge_config.CONNECTION_KEYS):
+            return
+
+        self.bec_client.setTarget(
+            new_config["bec_server_ipv4"],
+            new_config["bec_rcon_password"],
+            new_config["bec_rcon_port"])
+
+        # A running reconnect cycle, or a login for an earlier change, uses the new target on its next attempt.
+        if self.reconnecting:
+            self.reconnect_attempts = 0
+            return
+
+        # Dropping the old connection fires on_disconnect; hold the reconnect cycle off while we log in ourselves.
+        self.reconnecting = True
+        try:
+            logged_in = await self.bec_client.open()
+        except Exception as e:
+            print(f'RCON login failed: {e}')
+            logged_in = False
+        finally:
+            self.reconnecting = False
+
+        self.reconnect_attempts = 0
+        if logged_in:
+            print(f'Reconnected to {new_config["bec_server_ipv4"]}:{new_config["bec_rcon_port"]}.')
+        else:
+            self.start_reconnect()
 
         return
 
-    def heartbeat(self):
-        """The heartbeat keeps the client alive.
-        Calls itself every 30 seconds to make sure the clients do not close.
-        Also updates the player count at this time."""
+    async def start(self):
+        """Log in to the dayz server and start the heartbeat and config watcher.
+        Meant to run concurrently with the discord login."""
+
+        if self.snapshot_task is None:
+            self.restore_snapshot()
+            self.snapshot_task = asyncio.ensure_future(self.snapshot_loop())
 
-        Timer(
-            30, # Every thirty seconds...
-            lambda _: ( # ... do this set of instructions...
+        if self.config_watch_task is None:
+            self.config_watch_task = asyncio.ensure_future(self.config_service.watch())
 
-                # update the player count
-                asyncio.run_coroutine_threadsafe(
-                    self.update_player_count_in_discord_activity(),
-                    self.discord_client.loop),
+        if self.discord_sender_task is None:
+            self.discord_sender_task = asyncio.ensure_future(self.discord_sender())
 
-                # Call the keepalive function
-                asyncio.run_coroutine_threadsafe(
-                    self.update_player_count_in_discord_activity(),
-                    self.discord_client.loop),
+        self.player_stats.start()
+        self.audit_log.start()
+        self.broadcaster.start()
 
-                # call this timer again to repeat in 30 sec
-                self.heartbeat()),
-            [Event()]).start()  # ... starting now!
+        if self.bec_client is None:
+            print('No server configuration yet. Use )isc to set one up.')
+            return
+
+        # A failed login disconnects the client, which starts cycle_reconnect through the on_disconnect event.
+        try:
+            if await self.bec_client.open():
+                print('RCON login successful.')
+        except Exception as e:
+            print(f'RCON login failed: {e}')
+
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
 
         return
 
+    def snapshot_state(self) -> dict:
+        """Everything worth keeping across a restart, as plain data for bridge_snapshot."""
+
+        state = {
+            "players": self.player_index.to_snapshot(),
+            "bans": {"fetched_at": self.ban_cache_time, "entries": list(self.ban_cache.values())},
+            "discord_outbox": [list(item) for item in self.discord_outbox],
+        }
+
+        # Connection health (circuit state, reconnect attempts) describes a connection that is gone after a restart,
+        # so it is not kept.
+        if self.bec_client is not None:
+            state["server_messages"] = self.bec_client.serverMessage.to_snapshot()
+
+        return state
+
+    def save_snapshot(self):
+        """Write a snapshot right away, e.g. on shutdown."""
+        self.snapshot_store.write(self.snapshot_state())
+
+    async def snapshot_loop(self):
+        """Save the bridge state every snapshot_interval_s, off the event loop."""
+
+        while True:
+            await asyncio.sleep(self.bec_config.get("snapshot_interval_s", 15))
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, self.snapshot_store.write, self.snapshot_state())
+            except Exception as e:
+                print(f'Unable to save the bridge snapshot: {e}')
+
+    def restore_snapshot(self):
+        """Load the last snapshot. The roster and ban list are reconciled with the server as they are next fetched,
+        rather than all being queried again at startup."""
+
+        state = self.snapshot_store.read()
+        if state is None: return
+
+        self.player_index.load_snapshot(state.get("players", []))
+
+        bans = state.get("bans", {})
+        self.ban_cache = {entry[1].lower(): entry for entry in bans.get("entries", [])}
+        self.ban_cache_time = bans.get("fetched_at", 0.0)
+
+        # Undelivered messages go out before anything received since the restart.
+        self.discord_outbox.extendleft(tuple(item) for item in reversed(state.get("discord_outbox", [])))
+        if self.discord_outbox: self.outbox_ready.set()
+
+        if self.bec_client is not None:
+            self.bec_client.serverMessage.load_snapshot(state.get("server_messages", []))
+
+        age = f'{datetime.datetime.now().timestamp() - state["saved_at"]:.0f}s old' if state.get("saved_at") else 'undated'
+        print(f'Restored {age} snapshot: {len(self.player_index)} players, {len(self.ban_cache)} bans, '
+              f'{len(self.discord_outbox)} undelivered messages.')
+
+        return
+
+    async def refresh_bans(self, max_age_s: float = 3600) -> dict:
+        """Return the ban cache, fetching the ban list from the server only if the cache is older than max_age_s."""
+
+        if datetime.datetime.now().timestamp() - self.ban_cache_time < max_age_s: return self.ban_cache
+
+        self.ban_cache = {ban[1].lower(): ban for ban in await self.bec_client.getBansArray()}
+        self.ban_cache_time = datetime.datetime.now().timestamp()
+        return self.ban_cache
+
+    def queue_discord_message(self, channel_id: int, text: str):
+        """Queue a message for discord_sender to deliver."""
+
+        self.discord_outbox.append((int(channel_id), text))
+        self.outbox_ready.set()
+
+    async def discord_sender(self):
+        """Deliver queued messages in order. Anything still queued when the bot stops is in the snapshot,
+        and goes out after the restart."""
+
+        await self.discord_client.wait_until_ready()
+
+        while True:
+            if not self.discord_outbox:
+                self.outbox_ready.clear()
+                await self.outbox_ready.wait()
+                continue
+
+            channel_id, text = self.discord_outbox.popleft()
+            channel = self.discord_client.get_channel(channel_id)
+            if channel is None:
+                print(f'Dropping message for unknown channel {channel_id}: {text}')
+                continue
+
+            try:
+                await channel.send(text)
+            except discord.HTTPException as e:
+                # Put it back in front and try again shortly, so the order is kept.
+                print(f'Unable to deliver message to {channel_id}, retrying: {e}')
+                self.discord_outbox.appendleft((channel_id, text))
+                await asyncio.sleep(5)
+
+    async def heartbeat(self):
+        """Updates the player count every 30 seconds.
+        The ARC client sends its own keepalive packets, so this only needs to keep the activity fresh."""
+
+        await self.discord_client.wait_until_ready()
+
+        while True:
+            try:
+                await self.update_player_count_in_discord_activity()
+            except Exception as e:
+                print(f'Unable to update the player count: {e}')
+            await asyncio.sleep(30)
+
     async def get_debug_channel(self):
         """Get the guild's debug/logs channel"""
 
@@ -103,10 +334,18 @@ class Server_Bridge:
         await self.discord_client.change_presence(
             activity=discord.Activity(
                 type=discord.ActivityType.watching,
-                name=f'over {len(await self.bec_client.getPlayersArray())} survivors...'))
+                name=f'over {len(await self.refresh_roster())} survivors...'))
 
         return
 
+    async def refresh_roster(self) -> list:
+        """Fetch the player list from the dayz server and feed it to the player index and the player stats."""
+
+        player_list = await self.bec_client.getPlayersArray()
+        joined, left = self.player_index.update_roster(player_list)
+        self.player_stats.record(len(player_list), len(joined), len(left))
+        return player_list
+
     async def parse_message_rcon_to_discord(self, message: str):
         """Take a message given by the event and print it to the appropriate channels."""
 
@@ -114,25 +353,14 @@ class Server_Bridge:
 
         message = message.replace('@', '') # Don't let it ping people lol
 
-        # Get the target guild for this message
-        target_guild = self.discord_client.get_guild(int(self.bec_config["guild_id"]))
-
-        # If it's a global message, also print it to the bridge channel
+        # If it's a global message, also print it to the bridge channel, after formatting it to remove the extra stuff
         if "(Global)" in message and "-discord" not in message:
-
-            # Get the bridge channel by finding its id in the guild's list of text channels
-            bridge_channel = next(
-                text_channel for text_channel in target_guild.text_channels if text_channel.id == int(
-                    self.bec_config["guild_dayz_channel"])) # The channel id according to the config
-
-            # Send the message to the bridge channel, after formatting it to remove the extra stuff
-            await bridge_channel.send(re.match(r".*\(Global\) (.*)", message).groups()[0])
+            self.queue_discord_message(
+                self.bec_config["guild_dayz_channel"],
+                re.match(r".*\(Global\) (.*)", message).groups()[0])
 
         # Send all messages received to the logs channel
-        logs_channel = next(
-                text_channel for text_channel in target_guild.text_channels if text_channel.id == int(
-                    self.bec_config["guild_debug_channel"])) # The channel id according to the config
-        await logs_channel.send(message)
+        self.queue_discord_message(self.bec_config["guild_debug_channel"], message)
 
         return
 
@@ -140,6 +368,9 @@ class Server_Bridge:
         """This method takes a message sent by a user in the bridge channel, and then sends
         it to the dayz server as a formatted global message."""
 
+        # Nothing to bridge to until the server is configured.
+        if self.bec_client is None: return
+
         # If the message wasn't sent in one of the valid config channels, ignore it.
         if discord_message.channel.id not in [
                 self.bec_config['guild_dayz_channel'],
@@ -159,40 +390,57 @@ class Server_Bridge:
             source = ""
 
         # Send the message to the right client! Format it to be hopefully identical to how it prints in game
-        await self.bec_client.sayGlobal(f'{username}{source}: {discord_message.content}')
+        try:
+            await self.bec_client.sayTemplate(
+                -1, RELAY_TEMPLATE, username=username, source=source, content=discord_message.content)
+        except bec_rcon.Circuit_Open_Error:
+            # The server is down; mark the message as not delivered instead of holding up the channel.
+            await discord_message.add_reaction('⚠')
 
         return
 
+    def start_reconnect(self) -> asyncio.Future:
+        """Start the reconnect cycle, unless one is running already. Returns the task of the running cycle."""
+
+        if self.reconnect_task is None or self.reconnect_task.done():
+            self.reconnect_task = asyncio.ensure_future(self.cycle_reconnect())
+        return self.reconnect_task
+
     async def cycle_reconnect(self):
         """Try to reconnect once per minute, until reconnect_attempts surpasses the config maximum setting"""
 
-        debug_channel = await self.get_debug_channel()
+        # Every failed attempt disconnects again, which fires on_disconnect; only one cycle should run at a time.
+        if self.reconnecting: return False
+        self.reconnecting = True
 
-        # Check to see if we've hit the connection attempt limit
-        if self.reconnect_attempts > self.bec_config["maximum_reconnect_attempts"]:
-            await debug_channel.send('Unable to reconnect. Use ```)reconnect``` upon server restoration.')
-            print('Unable to reconnect. Use ```)reconnect``` upon server restoration.')
-            return False
+        try:
+            debug_channel = await self.get_debug_channel()
 
-        # Let everywhere know we're trying to reconnect
-        await debug_channel.send('Disconnected, attempting to reconnect...')
-        print('Disconnected, attempting to reconnect...')
+            while True:
 
-        # Wait the specified interval
-        await asyncio.sleep(self.bec_config["reconnect_attempt_interval_s"])
+                # Check to see if we've hit the connection attempt limit
+                if self.reconnect_attempts > self.bec_config["maximum_reconnect_attempts"]:
+                    await debug_channel.send('Unable to reconnect. Use ```)reconnect``` upon server restoration.')
+                    print('Unable to reconnect. Use ```)reconnect``` upon server restoration.')
+                    return False
 
-        # Try to reconnect.
-        await self.bec_client.connect()
+                # Let everywhere know we're trying to reconnect
+                await debug_channel.send('Disconnected, attempting to reconnect...')
+                print('Disconnected, attempting to reconnect...')
 
-        # If the client returns a successful keepAlive, the reconnect was successful. Reset the reconnect attempts.
-        if await self.bec_client.keepAlive():
-            self.reconnect_attempts = 0
-            await debug_channel.send('Successfully reconnected')
-            return True
+                # Wait the specified interval
+                await asyncio.sleep(self.bec_config["reconnect_attempt_interval_s"])
 
-        # Otherwise, try again and increment the attempts
-        self.reconnect_attempts += 1
-        return await self.cycle_reconnect()
+                # Try to reconnect. If the login is accepted, the reconnect was successful. Reset the reconnect attempts.
+                if await self.bec_client.open():
+                    self.reconnect_attempts = 0
+                    await debug_channel.send('Successfully reconnected')
+                    return True
+
+                # Otherwise, try again and increment the attempts
+                self.reconnect_attempts += 1
+        finally:
+            self.reconnecting = False
 
 
 class Steam_RCON(commands.Cog):
@@ -201,6 +449,22 @@ class Steam_RCON(commands.Cog):
         """_client is the discord.ext.commands.Bot object which acts as the interface to discord for the bot."""
         self._client = _client
         self.server_bridge = server_bridge
+        self.profiling = False
+        self.memory_tracker = None    # created by the first )profile mem
+        return
+
+    async def cog_command_error(self, command_context: commands.Context, error):
+        """Tell the moderator right away when a command was refused because the server is down.
+        Defining this handler turns off discord.py's default one for the whole cog, so every other error is printed
+        the way Bot.on_command_error would."""
+
+        original = getattr(error, 'original', error)
+        if isinstance(original, bec_rcon.Circuit_Open_Error):
+            await command_context.send(f'DayZ server unreachable: {original}')
+            return
+
+        print(f'Ignoring exception in command {command_context.command}:', file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
         return
 
     @commands.command(
@@ -219,26 +483,30 @@ class Steam_RCON(commands.Cog):
     async def initialize_server_configuration(self, command_context: commands.Context, *args):
 
         if len(args) != 5: # Make sure the command is formatted properly
-            await self.server_bridge.get_debug_channel().send(
+            await command_context.send(
                 'Please format the command correctly:\n> ' +
                 ')isc <ipv4> <port> "<rcon_password>" <bridge_channel_id> <moderation_channel_id>')
+            return
 
         guild_config = {
             "guild_alias": command_context.guild.name,
             "guild_id": command_context.guild.id,
             "bec_server_ipv4": args[0],
-            "bec_rcon_port": int(args[1]),
+            "bec_rcon_port": args[1],
             "bec_rcon_password": args[2],
             "guild_debug_channel": int(command_context.channel.id),
-            "guild_dayz_channel": int(args[3]),
-            "guild_moderation_channel": int(args[4]),
-            "maximum_reconnect_attempts": 100,
-            "reconnect_attempt_interval_s": 60
+            "guild_dayz_channel": args[3],
+            "guild_moderation_channel": args[4],
         }
 
-        # Write the config to the file
-        with open(r"resources\bec_server_config.json", encoding='utf8') as json_file:
-            json.dump(guild_config, json_file)
+        # Validate and write the config; the bridge picks it up right away.
+        try:
+            await self.server_bridge.config_service.update(guild_config)
+        except bridge_config.Config_Error as e:
+            await command_context.send(str(e))
+            return
+
+        await command_context.send('Server configuration saved and applied.')
 
         return
 
@@ -260,147 +528,363 @@ class Steam_RCON(commands.Cog):
             return
         await self.debugsub(cycle+1)
 
-    @commands.command(name='rcon_kick')
-    @commands.has_permissions(kick_members=True)
-    async def rcon_player_kick(self, command_context: commands.Context):
+    @commands.command(
+        name='profile',
+        help='Profile the running bot and post the report as attachments.\n'
+             ')profile [seconds] samples where the event loop spends its time (default 10s, at most 300s).\n'
+             ')profile mem start|diff|stop tracks memory growth: start takes a baseline, diff shows what grew since.')
+    @commands.has_guild_permissions(administrator=True)
+    async def profile(self, command_context: commands.Context, mode: str = 'cpu', argument: str = None):
 
-        # Get the moderation channel with which to work, and make sure the command was in it
-        moderation_channel = await self.server_bridge.get_moderation_channel()
-        if command_context.channel.id != moderation_channel.id: return
+        if mode == 'mem':
+            await self.profile_memory(command_context, argument or 'diff')
+            return
+
+        # ")profile 30" is short for ")profile cpu 30".
+        if mode.isdigit(): argument = mode
+        elif mode != 'cpu':
+            await command_context.send('Please format the command correctly:\n> )profile [cpu] [seconds] or )profile mem start|diff|stop')
+            return
+        seconds = min(int(argument), 300) if argument and argument.isdigit() else 10
+
+        if self.profiling:
+            await command_context.send('A profile is already running.')
+            return
+
+        self.profiling = True
+        try:
+            await command_context.send(f'Profiling for {seconds}s...')
+
+            # Only administrators ever profile, so the profiler (and tracemalloc) is not imported until then.
+            import bridge_profiler
+
+            # Commands run on the event loop's thread, which is the thread to sample.
+            profiler = bridge_profiler.Sampling_Profiler(threading.get_ident()).start()
+            await asyncio.sleep(seconds)
+            profiler.stop()
+
+            await command_context.send(files=[
+                discord.File(io.BytesIO(profiler.report().encode('utf8')), filename='profile.txt'),
+                discord.File(io.BytesIO(profiler.collapsed().encode('utf8')), filename='profile.collapsed'),
+            ])
+        finally:
+            self.profiling = False
 
-        # First, get the list of players on the server. [pid, ip, maybe player's server life id?, BE_UID, name]
-        player_list = await self.server_bridge.bec_client.getPlayersArray()
+        return
+
+    async def profile_memory(self, command_context: commands.Context, action: str):
+
+        if self.memory_tracker is None:
+            import bridge_profiler
+            self.memory_tracker = bridge_profiler.Memory_Tracker()
+
+        if action == 'start':
+            self.memory_tracker.start()
+            await command_context.send('Memory tracking started. Use )profile mem diff to see what grew since.')
+
+        elif action == 'stop':
+            self.memory_tracker.stop()
+            await command_context.send('Memory tracking stopped.')
+
+        elif action == 'diff':
+            if not self.memory_tracker.running:
+                await command_context.send('Memory tracking is not running. Start it with )profile mem start')
+                return
+            await command_context.send(file=discord.File(
+                io.BytesIO(self.memory_tracker.diff().encode('utf8')), filename='memory.txt'))
+
+        else:
+            await command_context.send('Please format the command correctly:\n> )profile mem start|diff|stop')
+
+        return
+
+    @commands.command(
+        name='announce',
+        help='Broadcast a global message to every managed DayZ server.')
+    @commands.has_guild_permissions(administrator=True)
+    async def announce(self, command_context: commands.Context, *, message: str):
+
+        started = time.perf_counter()
+        results = await bec_fleet.fleet_say(self.server_bridge.managed_clients(), f'Big Brother: {message}')
+        for alias, result in results.items():
+            self.server_bridge.audit_log.record(
+                'announce', command_context.author, reason=message, server=alias,
+                result='ok' if result.error is None else f'failed: {result.error}',
+                latency_s=time.perf_counter() - started)
 
-        # print their information out, ordered and selectable.
-        kick_choices = 'Select from the list below who to kick. Send a message formatted as:\n> ' \
-                       '<#> <Reason for kick>' \
-                       '\n'
-        for player in player_list: kick_choices += f'\n{player_list.index(player)} : {player[4]} : {player[3]}'
-        await moderation_channel.send(kick_choices)
+        # One line per server, so a failure on one server is not lost among the others.
+        await command_context.send('\n'.join(
+            f'{alias}: ' + ('sent' if result.error is None else f'failed ({result.error})')
+            for alias, result in results.items()) or 'No servers configured.')
+
+        return
+
+    @commands.command(
+        name='fleet_players',
+        help='Show how many players are on every managed DayZ server.')
+    @commands.has_guild_permissions(administrator=True)
+    async def fleet_players(self, command_context: commands.Context):
+
+        results = await bec_fleet.fleet_players(self.server_bridge.managed_clients())
+
+        await command_context.send('\n'.join(
+            f'{alias}: ' + (f'{len(result.response)} players' if result.error is None else f'unavailable ({result.error})')
+            for alias, result in results.items()) or 'No servers configured.')
+
+        return
+
+    @commands.command(
+        name='stats',
+        help='Player numbers over a time range: peak, low and average players, joins and leaves, '
+             'and the average per hour of the day. The range is e.g. 24h (default), 7d, 2w, 3m or 1y.'
+             '\nExample: )stats 7d')
+    async def stats(self, command_context: commands.Context, time_range: str = '24h'):
+
+        try:
+            summary = self.server_bridge.player_stats.summary(bridge_stats.parse_range(time_range))
+        except ValueError as e:
+            await command_context.send(str(e))
+            return
 
-        # Wait for a reply which says which user to kick.
+        if summary is None:
+            await command_context.send(f'No player numbers recorded in the last {time_range} yet.')
+            return
+
+        peak_at = datetime.datetime.utcfromtimestamp(summary["peak_at"]).strftime('%Y-%m-%d %H:%M')
+        lines = [
+            f'**Players over the last {time_range}**',
+            f'Peak: {summary["peak"]} (around {peak_at} UTC), low: {summary["low"]}, average: {summary["average"]:.1f}',
+            f'Joins: {summary["joins"]}, leaves: {summary["leaves"]}',
+        ]
+
+        # The quiet hours are where a restart bothers the fewest players.
+        hours = [(average, hour) for hour, average in enumerate(summary["hourly_average"]) if average is not None]
+        if hours:
+            hours.sort()
+            lines.append('Quietest hours (UTC): ' + ', '.join(f'{hour:02d}:00 ({average:.1f})' for average, hour in hours[:3]))
+            lines.append('Busiest hours (UTC): ' + ', '.join(f'{hour:02d}:00 ({average:.1f})' for average, hour in hours[:-4:-1]))
+
+        await self.send_lines(command_context, lines)
+
+        return
+
+    async def pick_player(self, command_context: commands.Context, moderation_channel, query: str):
+        """Work out which player a moderator means. The query can be part of a name, a GUID or an IP.
+        A clear match is returned straight away; otherwise the moderator picks from a short ranked list.
+        Returns a bridge_players.Player_Record, or None if there is nobody to pick."""
+
+        await self.server_bridge.refresh_roster()
+        player_index = self.server_bridge.player_index
+
+        # Without a query, choose from everyone online, as before.
+        if query is None:
+            player, candidates = None, [(0, online_player) for online_player in player_index.online()]
+        else:
+            player, candidates = player_index.resolve(query)
+        if player is not None: return player
+
+        if not candidates:
+            await moderation_channel.send(f'No player matches `{query}`.' if query else 'Nobody is online.')
+            return None
+
+        # The numbers refer to this list, not the live roster, so players joining or leaving meanwhile don't matter.
+        choices = ['Several players match. Reply with the number of the one you mean:' if query else
+                   'Reply with the number of the player:']
+        for position, (score, candidate) in enumerate(candidates):
+            choices.append(f'{position} : {candidate.name} : {candidate.guid}' + ('' if candidate.online else ' (left)'))
+        await self.send_lines(moderation_channel, choices)
+
+        # Wait for a reply which says which player was meant.
         reply_message = await self._client.wait_for(
             'message',
             check=lambda reply: False not in (
                 reply.author.id == command_context.author.id,
                 reply.channel.id == command_context.channel.id,
-                re.match(r"^\d* .*", reply.content) is not None
+                re.match(r"^\d+$", reply.content.strip()) is not None
             ),
             timeout=120
         )
 
-        # Interpret the reply message above. Get the player from the array.
-        reply_message_interpretation = re.match(r"^(?P<index>\d*) (?P<kick_reason>.*)", reply_message.content)
-        player_to_kick_raw = player_list[int(reply_message_interpretation.group('index'))]
-        player_to_kick = {
-            "Name": player_to_kick_raw[4],
-            "IP Address": player_to_kick_raw[1],
-            "BattleEye ID": player_to_kick_raw[3], # Do not kick using this as an identifier.
-            "Server Lifetime ID": player_to_kick_raw[2],
-            "Server Instance ID": player_to_kick_raw[0],
-        }
+        position = int(reply_message.content.strip())
+        if position >= len(candidates):
+            await moderation_channel.send(f'There is no number {position} in the list.')
+            return None
+        return candidates[position][1]
 
-        # Confirm the identity of the user to kick.
-        kick_embed = discord.Embed(
-            color=discord.Color.red(),
-            title='Confirm Player Kick',
-            description=reply_message_interpretation.group('kick_reason')
-        )
-        for parameter in [*player_to_kick.keys()]:
-            kick_embed.add_field(
-                name=parameter,
-                value=player_to_kick[parameter],
-                inline=False)
-        kick_message = await moderation_channel.send(embed=kick_embed)
+    @staticmethod
+    async def send_lines(channel, lines: list, limit: int = 1900):
+        """Send lines as few messages as possible, each under discord's length limit."""
+
+        message = ''
+        for line in lines:
+            if message and len(message) + len(line) + 1 > limit:
+                await channel.send(message)
+                message = ''
+            message += ('\n' if message else '') + line
+        if message: await channel.send(message)
+
+    async def confirm(self, command_context: commands.Context, moderation_channel, embed: discord.Embed) -> bool:
+        """Post the embed and wait for the moderator to react with a check mark or a cross."""
+
+        confirm_message = await moderation_channel.send(embed=embed)
 
         # Add reactions to the message and wait for the user to confirm with them.
-        for emote in ["✅", "❌"]: await kick_message.add_reaction(emote)
+        for emote in ["✅", "❌"]: await confirm_message.add_reaction(emote)
 
         # Wait for the original author to add a reaction from the above two.
         reply_emote = await self._client.wait_for(
             'reaction_add',
             check=lambda reaction, user: False not in (
-                reaction.message.id == kick_message.id, # Make sure the reacted message is the embed
-                user.id == reply_message.author.id, # Make sure the reaction was added by the og kicker
+                reaction.message.id == confirm_message.id, # Make sure the reacted message is the embed
+                user.id == command_context.author.id, # Make sure the reaction was added by the moderator
             ),
             timeout=120
         )
 
-        # If the added emote is the check mark, perform the kick.
-        if reply_emote[0].emoji == "✅":
-            await self.server_bridge.bec_client.kickPlayer(player_to_kick["Server Instance ID"])
+        return reply_emote[0].emoji == "✅"
+
+    @commands.command(
+        name='rcon_kick',
+        help='Kick a player from the DayZ server. The player can be given by (part of) their name, GUID or IP. '
+             'Quote names with spaces.\nExample: )rcon_kick "Bobby T" Spawn camping')
+    @commands.has_permissions(kick_members=True)
+    async def rcon_player_kick(self, command_context: commands.Context, query: str = None, *,
+                               reason: str = 'Admin Kick'):
+
+        # Get the moderation channel with which to work, and make sure the command was in it
+        moderation_channel = await self.server_bridge.get_moderation_channel()
+        if command_context.channel.id != moderation_channel.id: return
+
+        player_to_kick = await self.pick_player(command_context, moderation_channel, query)
+        if player_to_kick is None: return
+        if not player_to_kick.online:
+            await moderation_channel.send(f'{player_to_kick.name} is not on the server.')
+            return
+
+        # Confirm the identity of the user to kick.
+        kick_embed = discord.Embed(
+            color=discord.Color.red(),
+            title='Confirm Player Kick',
+            description=reason
+        )
+        for parameter, value in player_to_kick.as_dict().items():
+            kick_embed.add_field(
+                name=parameter,
+                value=value,
+                inline=False)
+
+        audit = lambda result, latency_s=None: self.server_bridge.audit_log.record(
+            'kick', command_context.author, player_to_kick.guid, player_to_kick.name, reason, result=result,
+            latency_s=latency_s)
+
+        # If the moderator confirms, perform the kick.
+        if not await self.confirm(command_context, moderation_channel, kick_embed):
+            audit('cancelled')
+            return
+
+        # Player ids are handed out again as people leave and join, so look the id up again by GUID right before kicking.
+        await self.server_bridge.refresh_roster()
+        current_record = self.server_bridge.player_index.get(player_to_kick.guid)
+        if current_record is None or not current_record.online:
+            await moderation_channel.send('The player left the server before the kick.')
+            audit('left before the kick')
+            return
+        player_to_kick = current_record
+
+        started = time.perf_counter()
+        try:
+            await self.server_bridge.bec_client.kickPlayer(player_to_kick.player_id, reason)
+        except Exception as e:
+            audit(f'failed: {e}', time.perf_counter() - started)
+            raise
+        audit('ok', time.perf_counter() - started)
 
         return
 
-    @commands.command(name='rcon_ban')
+    @commands.command(
+        name='rcon_ban',
+        help='Ban a player from the DayZ server by their BattlEye GUID. The player can be given by (part of) their name, '
+             'GUID or IP, and may have left already. Duration is in minutes, 0 or none for a permanent ban.'
+             '\nExample: )rcon_ban "Bobby T" 1440 Cheating')
     @commands.has_permissions(ban_members=True)
-    async def rcon_player_ban(self, command_context: commands.Context):
+    async def rcon_player_ban(self, command_context: commands.Context, query: str = None,
+                              duration: typing.Optional[int] = 0, *, reason: str = 'Banned'):
 
         moderation_channel = await self.server_bridge.get_moderation_channel()
         if command_context.channel.id != moderation_channel.id: return
 
-        # First, get the list of players on the server. [pid, ip, a number?, BE_UID, name]
-        player_list = await self.server_bridge.bec_client.getPlayersArray()
-
-        # print their information out, ordered and selectable.
-        ban_choices = 'Select from the list below who to ban. Send a message formatted as:\n> ' \
-                      '<#> <duration in seconds> <Reason for ban>' \
-                      '\n'
-        for player in player_list: ban_choices += f'\n{player_list.index(player)} : {player[4]} : {player[3]}'
-        await moderation_channel.send(ban_choices)
-
-        # Wait for a reply which says which user to kick.
-        reply_message = await self._client.wait_for(
-            'message',
-            check=lambda reply: False not in (
-                reply.author.id == command_context.author.id,
-                reply.channel.id == command_context.channel.id,
-                re.match(r"^\d* \d* .*", reply.content) is not None
-            ),
-            timeout=120
-        )
+        player_to_ban = await self.pick_player(command_context, moderation_channel, query)
+        if player_to_ban is None: return
 
-        # Interpret the reply message above. Get the player from the array.
-        reply_message_interpretation = re.match(
-            r"^(?P<index>\d*) (?P<ban_duration>\d*) (?P<ban_reason>.*)", reply_message.content)
-        player_to_ban_raw = player_list[int(reply_message_interpretation.group('index'))]
-        player_to_ban = {
-            "Name": player_to_ban_raw[4],
-            "IP Address": player_to_ban_raw[1],
-            "BattleEye ID": player_to_ban_raw[3],
-            "Server Lifetime ID": player_to_ban_raw[2],
-            "Server Instance ID": player_to_ban_raw[0],
-        }
+        # Mention an existing ban, so it is not replaced by accident.
+        existing_ban = (await self.server_bridge.refresh_bans()).get(player_to_ban.guid.lower())
 
-        # Confirm the identity of the user to kick. Print an embed showing their information.
+        # Confirm the identity of the user to ban. Print an embed showing their information.
         ban_embed = discord.Embed(
             color=discord.Color.red(),
             title='Confirm Player Ban',
-            description=f'<{reply_message_interpretation.group("ban_duration")}> seconds \n ' +
-                        f'{reply_message_interpretation.group("ban_reason")}'
+            description=(f'<{duration}> minutes' if duration else 'Permanent') + f' \n {reason}' +
+                        (f'\n Already banned: {existing_ban[2]} ({existing_ban[3]})' if existing_ban else '')
         )
-        for parameter in [*player_to_ban.keys()]:
+        for parameter, value in player_to_ban.as_dict().items():
             ban_embed.add_field(
                 name=parameter,
-                value=player_to_ban[parameter],
+                value=value,
                 inline=False)
-        ban_message = await moderation_channel.send(embed=ban_embed)
 
-        # Add reactions to the message and wait for the user to confirm with them.
-        for emote in ["✅", "❌"]: await ban_message.add_reaction(emote)
+        audit = lambda result, latency_s=None: self.server_bridge.audit_log.record(
+            'ban', command_context.author, player_to_ban.guid, player_to_ban.name, reason, duration, result=result,
+            latency_s=latency_s)
 
-        # Wait for the original author to add a reaction from the above two.
-        reply_emote = await self._client.wait_for(
-            'reaction_add',
-            check=lambda reaction, user: False not in (
-                reaction.message.id == ban_message.id,  # Make sure the reacted message is the embed
-                user.id == reply_message.author.id,  # Make sure the reaction was added by the og kicker
-            ),
-            timeout=120
-        )
+        # If the moderator confirms, ban the GUID. This also works for players who already left.
+        if not await self.confirm(command_context, moderation_channel, ban_embed):
+            audit('cancelled')
+            return
+
+        started = time.perf_counter()
+        try:
+            await self.server_bridge.bec_client.addBan(player_to_ban.guid, reason, duration)
+        except Exception as e:
+            audit(f'failed: {e}', time.perf_counter() - started)
+            raise
+        audit('ok', time.perf_counter() - started)
+        self.server_bridge.ban_cache_time = 0.0  # the new ban id is only known after the next fetch
+
+        return
+
+    @commands.command(
+        name='history',
+        help='Show the moderation history of a player, given by GUID or (part of) their name, '
+             'or the actions of a moderator, given by mentioning them.\nExample: )history "Bobby T" or )history @Moderator')
+    @commands.has_permissions(kick_members=True)
+    async def history(self, command_context: commands.Context, query: str = None, limit: int = 10):
+
+        audit_log = self.server_bridge.audit_log
+        if command_context.message.mentions:
+            moderator = command_context.message.mentions[0]
+            title, records = f'Actions by {moderator}', await audit_log.history(actor_id=moderator.id, limit=limit)
+        elif query is not None:
+            # Players who are no longer in the index can still be looked up by GUID.
+            player, candidates = self.server_bridge.player_index.resolve(query)
+            guid = player.guid if player is not None else query if bridge_players.GUID_PATTERN.match(query) else None
+            if guid is None:
+                await command_context.send(f'No single player matches `{query}`. Try their GUID.' + ''.join(
+                    f'\n{candidate.name} : {candidate.guid}' for score, candidate in candidates))
+                return
+            title, records = f'History of {player.name if player else guid}', await audit_log.history(guid, limit=limit)
+        else:
+            await command_context.send('Please format the command correctly:\n> )history <player or GUID> or )history @moderator')
+            return
+
+        lines = [f'**{title}**']
+        for record in records:
+            when = datetime.datetime.utcfromtimestamp(record["time"]).strftime('%Y-%m-%d %H:%M')
+            duration = '' if record["action"] != 'ban' else f' {record["duration"]} min' if record["duration"] else ' permanent'
+            latency = f' ({record["latency_ms"]:.0f} ms)' if record["latency_ms"] is not None else ''
+            lines.append(f'{when} UTC {record["action"]}{duration} of {record["target"] or record.get("server", "")} '
+                         f'by {record["actor"]}: {record["reason"]} -> {record["result"]}{latency}')
+        if not records: lines.append('Nothing recorded.')
 
-        # If the added emote is the check mark. Do we need to kick them too?
-        if reply_emote[0].emoji == "✅":
-            await self.server_bridge.bec_client.addBan(player_to_ban["BattleEye ID"])
+        await self.send_lines(command_context, lines)
 
         return
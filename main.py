@@ -1,9 +1,12 @@
 import os
+import asyncio
 import logging
 from dotenv import load_dotenv
 import discord
 from discord.ext import commands
 from cog_rcon import Server_Bridge, Steam_RCON
+from bridge_loop import new_event_loop, Slow_Callback_Watchdog
+from bridge_audit import Batched_Writer
 
 LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s - %(message)s'
 log = logging.getLogger(__name__)
@@ -12,23 +15,30 @@ log = logging.getLogger(__name__)
 def run_bot():
     load_dotenv()  # Load the environment file, which contains the bot token
 
+    # Pick the loop before anything binds to one. EVENT_LOOP=auto (uvloop if installed), uvloop or asyncio
+    loop, loop_backend = new_event_loop(os.getenv('EVENT_LOOP', 'auto'))
+    print(f'Running on the {loop_backend} event loop.')
+
+    # Log anything that blocks the loop for longer than SLOW_CALLBACK_MS. 0 turns the watchdog off.
+    slow_callback_ms = int(os.getenv('SLOW_CALLBACK_MS', '100'))
+
     # Create the client through which the bot can communicate with discord
     _client = commands.Bot(
         command_prefix=')',
-        activity=discord.Game(name=')help')
+        activity=discord.Game(name=')help'),
+        loop=loop
     )
 
-    # Create the client through which the bot can commmunicate with DayZ
+    # Create the client through which the bot can commmunicate with DayZ. It logs in once start() runs.
     server_bridge = Server_Bridge(_client)
 
+    # Register the cog once, up front, so commands work as soon as the gateway is ready and
+    # reconnecting to the gateway (which fires on_ready again) does not add it a second time.
+    _client.add_cog(Steam_RCON(_client, server_bridge))
+
     @_client.event # Let the system know that it's ready to go.
     async def on_ready():
-
-        # Once the client is ready, add the cog with the server bridge attached to it.
-        _client.add_cog(Steam_RCON(_client, server_bridge))
-
         print(f'System {_client.user} initialized. Beginning guild observation.')
-
         return
 
     @_client.event  # handle messages before passing them to the command processing.
@@ -41,15 +51,32 @@ def run_bot():
         # Pass the message to the command handler, where it will check the cogs to see if it's a valid command.
         await _client.process_commands(message)
 
+    # Errors are appended to err.log by a background writer, so a burst of them does not stall the loop on the disk.
+    error_log = Batched_Writer('err.log', fsync=False)
+
     @_client.event  # When an error happens, write it to the log
     async def on_error(event, *args):
-        with open('err.log', 'a') as f:
-            if event == 'on_message':
-                f.write(f'Unhandled message: {args[0]}\n')
-            else:
-                raise
-
-    _client.run(os.getenv('TOKEN'))  # Run the client! :D
+        if event == 'on_message':
+            error_log.write(f'Unhandled message: {args[0]}\n')
+        else:
+            raise
+
+    async def start():
+        if slow_callback_ms > 0: Slow_Callback_Watchdog(loop, slow_callback_ms / 1000).start()
+        error_log.start()
+
+        # Log in to discord and to the DayZ server at the same time.
+        await asyncio.gather(_client.start(os.getenv('TOKEN')), server_bridge.start())
+
+    try:
+        loop.run_until_complete(start())  # Run the client! :D
+    except KeyboardInterrupt:
+        loop.run_until_complete(_client.close())
+    finally:
+        server_bridge.save_snapshot()  # keep whatever changed since the last periodic snapshot
+        server_bridge.player_stats.flush()
+        server_bridge.audit_log.flush()
+        error_log.flush()
 
 
 if __name__ == "__main__":
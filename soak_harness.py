@@ -0,0 +1,491 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import bec_rcon
+import bridge_audit
+import bridge_broadcasts
+import bridge_config
+import bridge_snapshot
+import bridge_stats
+from cog_rcon import Server_Bridge
+
+# Long running soak test of the bridge: a Server_Bridge runs against a scripted BattlEye RCon peer on localhost
+# and a stand-in discord client, through hours of chat traffic, commands, dropped connections and server restarts.
+# Memory, tasks, threads, file descriptors and relay latency are sampled throughout; the exit code is 1 when any of
+# them grew past its threshold, so the harness can gate a release:
+#
+#     python soak_harness.py --duration-s 14400 --push-rate 50
+
+RCON_PASSWORD = 'soak'
+GUILD_ID = 1
+DEBUG_CHANNEL_ID = 10
+DAYZ_CHANNEL_ID = 11
+MODERATION_CHANNEL_ID = 12
+
+MARKER_PATTERN = re.compile(r'soak (\d+)')
+
+# How long after an outage or a reconnect the bridge may still be catching up (timeouts, reconnect interval, resends).
+RECOVERY_S = 15
+
+
+def be_packet(payload: bytes) -> bytes:
+    """Frame a payload (starting at the 0xFF byte) the way BattlEye does: 'BE', crc32, payload."""
+    return b'BE' + struct.pack('<I', zlib.crc32(payload)) + payload
+
+
+def resident_bytes():
+    """Resident set size of this process, or None where /proc is not available."""
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def open_descriptors():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def percentile(values: list, fraction: float):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Scripted_BE_Peer(asyncio.DatagramProtocol):
+    """A BattlEye RCon server that answers logins and commands, pushes chat, and can be made to go silent or restart.
+    Like the real server it resends pushed messages until they are acknowledged, and splits long answers
+    into multi packet responses."""
+
+    def __init__(self, password: str, players: int = 40, chunk_bytes: int = 1000, drop_part_rate: float = 0.0):
+        self.password = password
+        self.chunk_bytes = chunk_bytes
+        self.drop_part_rate = drop_part_rate
+        self.transport = None
+        self.port = 0
+        self.client_address = None   # the logged in client; forgotten when the server restarts
+        self.silent = False          # drop everything, as if the network went away
+        self.push_sequence = 0
+        self.unacked = dict()        # sequence -> [packet, last sent, tries]
+        self.answers = 0
+        self.logins = 0
+        self.roster = [self.new_player(index) for index in range(players)]
+        self.players_created = players
+        return
+
+    @staticmethod
+    def new_player(number: int) -> list:
+        return [f'{number:032x}', f'Survivor {number}', f'10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}']
+
+    async def start(self, loop, port: int = 0):
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=('127.0.0.1', port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+
+    def stop(self):
+        if self.transport is not None: self.transport.close()
+        self.transport = None
+        self.client_address = None
+        self.unacked.clear()
+
+    async def restart(self, downtime_s: float):
+        """Close the port and open it again later; the client has to notice and log in again."""
+
+        self.stop()
+        await asyncio.sleep(downtime_s)
+        await self.start(asyncio.get_event_loop(), self.port)
+
+    async def go_silent(self, downtime_s: float):
+        """Keep the port open but answer nothing, so the client only notices through timeouts."""
+
+        self.silent = True
+        await asyncio.sleep(downtime_s)
+        self.silent = False
+
+    def send(self, payload: bytes):
+        if self.transport is not None and self.client_address is not None:
+            self.transport.sendto(be_packet(payload), self.client_address)
+
+    def datagram_received(self, data: bytes, address):
+        if self.silent or len(data) < 9 or data[:2] != b'BE': return
+        if zlib.crc32(data[6:]) != struct.unpack_from('<I', data, 2)[0]: return
+
+        packet_type = data[7]
+        if packet_type == 0x00:
+            accepted = data[8:].decode('iso-8859-1') == self.password
+            self.client_address = address if accepted else None
+            self.logins += 1
+            self.transport.sendto(be_packet(b'\xff\x00' + (b'\x01' if accepted else b'\x00')), address)
+        elif address != self.client_address:
+            return  # not logged in, e.g. from before a restart; the real server ignores these too
+        elif packet_type == 0x01:
+            self.answer(data[8], data[9:].decode('utf-8', 'replace'))
+        elif packet_type == 0x02:
+            self.unacked.pop(data[8], None)
+
+    def answer(self, sequence: int, command: str):
+        self.answers += 1
+        body = self.command_output(command).encode('utf-8')
+        if len(body) <= self.chunk_bytes:
+            self.send(b'\xff\x01' + bytes([sequence]) + body)
+            return
+
+        chunks = [body[start:start + self.chunk_bytes] for start in range(0, len(body), self.chunk_bytes)]
+        for index, chunk in enumerate(chunks):
+            # A lost part leaves a partial answer behind on the client, which must not pile up.
+            if self.drop_part_rate and index and (self.answers * 7919 + index) % 1000 < self.drop_part_rate * 1000: continue
+            self.send(b'\xff\x01' + bytes([sequence, 0, len(chunks), index]) + chunk)
+
+    def command_output(self, command: str) -> str:
+        if command == 'players':
+            self.churn()
+            lines = ['Players on server:', '[#] [IP Address]:[Port] [Ping] [GUID] [Name]',
+                     '--------------------------------------------------']
+            lines += [f'{index}   {ip}:2304   45   {guid}(OK) {name}' for index, (guid, name, ip) in enumerate(self.roster)]
+            lines.append(f'({len(self.roster)} players in total)')
+            return '\n'.join(lines)
+        if command == 'bans':
+            return ('GUID Bans:\n[#] [GUID] [Minutes left] [Reason]\n----------------------------------------\n' +
+                    ''.join(f'{index}  {index:032x} perm Cheating\n' for index in range(50)))
+        if command == 'version':
+            return '1.222'
+        return ''
+
+    def churn(self):
+        """A couple of players leave and new ones join between roster fetches, so the bridge keeps meeting new people."""
+
+        for _ in range(2):
+            self.roster.pop(0)
+            self.roster.append(self.new_player(self.players_created))
+            self.players_created += 1
+
+    def push(self, text: str):
+        if self.transport is None or self.client_address is None or self.silent: return
+
+        payload = b'\xff\x02' + bytes([self.push_sequence]) + text.encode('utf-8')
+        self.unacked[self.push_sequence] = [payload, time.monotonic(), 1]
+        self.push_sequence = (self.push_sequence + 1) % 256
+        self.send(payload)
+
+    def resend_unacked(self, after_s: float = 1.0, tries: int = 5):
+        now = time.monotonic()
+        for sequence, entry in list(self.unacked.items()):
+            if now - entry[1] < after_s: continue
+            if entry[2] >= tries or self.silent:
+                del self.unacked[sequence]
+                continue
+            entry[1], entry[2] = now, entry[2] + 1
+            self.send(entry[0])
+
+
+class Fake_Message:
+    def __init__(self, channel, content: str, author=None):
+        self.channel = channel
+        self.content = content
+        self.author = author
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+
+class Fake_Author:
+    def __init__(self, name: str):
+        self.name = name
+        self.id = 0
+        self.bot = False
+
+
+class Fake_Channel:
+    """A text channel that records what the bridge delivers to it instead of calling discord."""
+
+    def __init__(self, channel_id: int, name: str, on_send=None):
+        self.id = channel_id
+        self.name = name
+        self.on_send = on_send
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        if self.on_send is not None: self.on_send(self, content)
+        return Fake_Message(self, content)
+
+
+class Fake_Guild:
+    def __init__(self, guild_id: int, name: str, text_channels: list):
+        self.id = guild_id
+        self.name = name
+        self.text_channels = text_channels
+
+
+class Fake_Discord_Client:
+    """Just enough of discord.ext.commands.Bot for Server_Bridge."""
+
+    def __init__(self, loop, guild: Fake_Guild):
+        self.loop = loop
+        self.command_prefix = ')'
+        self.guild = guild
+        self.presence_updates = 0
+
+    def get_guild(self, guild_id: int):
+        return self.guild if guild_id == self.guild.id else None
+
+    def get_channel(self, channel_id: int):
+        return next((channel for channel in self.guild.text_channels if channel.id == channel_id), None)
+
+    async def wait_until_ready(self):
+        return
+
+    async def change_presence(self, **kwargs):
+        self.presence_updates += 1
+
+
+class Soak_Harness:
+
+    def __init__(self, args):
+        self.args = args
+        self.output = sys.stdout
+        self.pushed = dict()     # marker -> time.monotonic() the peer pushed it
+        self.marker = 0
+        self.latencies = []      # relay latencies of the current sample interval, in seconds
+        self.delivered = 0
+        self.lost = 0
+        self.say_errors = 0
+        self.samples = []
+        self.failures = []
+        self.outage_until = 0.0  # time.monotonic() until which the bridge may be recovering from an outage
+        self.interval_start = 0.0
+        self.logins = 0          # peer logins at the last sample; a new login means the bridge had to reconnect
+        return
+
+    def report(self, line: str):
+        print(line, file=self.output, flush=True)
+
+    def on_send(self, channel: Fake_Channel, content):
+        """Relay latency: from the peer pushing a chat line to the bridge posting it in the bridge channel."""
+
+        if channel.id != DAYZ_CHANNEL_ID or content is None: return
+        match = MARKER_PATTERN.search(content)
+        pushed_at = self.pushed.pop(int(match.group(1)), None) if match else None
+        if pushed_at is None: return
+        self.latencies.append(time.monotonic() - pushed_at)
+        self.delivered += 1
+
+    async def push_traffic(self, peer: Scripted_BE_Peer):
+        interval = 1 / self.args.push_rate
+        while True:
+            await asyncio.sleep(interval)
+            peer.resend_unacked()
+            if peer.client_address is None or peer.silent: continue
+            self.marker += 1
+            self.pushed[self.marker] = time.monotonic()
+            peer.push(f'(Global) Survivor {self.marker % 40}: soak {self.marker}')
+
+    async def discord_traffic(self, bridge: Server_Bridge, channel: Fake_Channel):
+        author = Fake_Author('Moderator')
+        while True:
+            await asyncio.sleep(1 / self.args.say_rate)
+            try:
+                await bridge.parse_message_discord_to_rcon(Fake_Message(channel, f'hello from discord {self.marker}', author))
+            except Exception:
+                self.say_errors += 1
+
+    async def chaos(self, peer: Scripted_BE_Peer):
+        """Alternate between silent outages and server restarts."""
+
+        outages = 0
+        while True:
+            await asyncio.sleep(self.args.outage_every_s)
+            outages += 1
+            self.outage_until = time.monotonic() + self.args.downtime_s + RECOVERY_S
+            if outages % 2:
+                self.report(f'-- peer silent for {self.args.downtime_s}s')
+                await peer.go_silent(self.args.downtime_s)
+            else:
+                self.report(f'-- peer restarting, down for {self.args.downtime_s}s')
+                await peer.restart(self.args.downtime_s)
+
+    def sample(self, started: float, bridge: Server_Bridge, peer: Scripted_BE_Peer):
+        # Pushes that never arrived, e.g. sent just as the connection went down, are counted as lost.
+        now = time.monotonic()
+        for marker, pushed_at in list(self.pushed.items()):
+            if now - pushed_at > 30:
+                del self.pushed[marker]
+                self.lost += 1
+
+        if peer.logins != self.logins: self.outage_until = max(self.outage_until, now + RECOVERY_S)
+        self.logins = peer.logins
+
+        bec_client = bridge.bec_client
+        sample = {
+            "t": now - started,
+            "rss": resident_bytes(),
+            "tasks": len(asyncio.all_tasks()),
+            "threads": threading.active_count(),
+            "fds": open_descriptors(),
+            "p50": percentile(self.latencies, 0.5),
+            "p99": percentile(self.latencies, 0.99),
+            "relayed": len(self.latencies),
+            "multipackets": len(bec_client.MultiPackets),
+            "pending": len(bec_client.pendingCommands),
+            "players": len(bridge.player_index),
+            "outbox": len(bridge.discord_outbox),
+            "outage": self.interval_start < self.outage_until,
+        }
+        self.latencies = []
+        self.interval_start = now
+        self.samples.append(sample)
+
+        rss = f'{sample["rss"] / 1e6:7.1f} MB' if sample["rss"] is not None else '      n/a'
+        latency = f'{sample["p50"] * 1000:6.1f}/{sample["p99"] * 1000:6.1f} ms' if sample["p99"] is not None else '        n/a'
+        self.report(f'{sample["t"]:8.0f}s rss {rss} tasks {sample["tasks"]:4d} threads {sample["threads"]:3d} '
+                    f'fds {sample["fds"]} relay p50/p99 {latency} ({sample["relayed"]}) '
+                    f'multipackets {sample["multipackets"]} pending {sample["pending"]} players {sample["players"]} '
+                    f'outbox {sample["outbox"]} lost {self.lost}' + (' (outage)' if sample["outage"] else ''))
+
+    def evaluate(self) -> bool:
+        """Compare the end of the run with the first sample after the warm up."""
+
+        baseline = next((sample for sample in self.samples if sample["t"] >= self.args.warmup_s), None)
+        if baseline is None or baseline is self.samples[-1]:
+            self.failures.append('run too short to compare against the warm up baseline')
+            return False
+        final = self.samples[-1]
+
+        def check_growth(key, limit, scale=1, unit=''):
+            if baseline[key] is None or final[key] is None: return
+            growth = (final[key] - baseline[key]) / scale
+            if growth > limit: self.failures.append(f'{key} grew by {growth:.1f}{unit} (limit {limit}{unit})')
+
+        check_growth("rss", self.args.max_rss_growth_mb, 1e6, ' MB')
+        check_growth("tasks", self.args.max_task_growth)
+        check_growth("threads", self.args.max_thread_growth)
+        check_growth("fds", self.args.max_fd_growth)
+
+        # Lines pushed around an outage or a reconnect (e.g. after a lost answer part) wait for the login;
+        # the latency limit is for normal operation.
+        worst_p99 = max((sample["p99"] for sample in self.samples[self.samples.index(baseline):]
+                         if sample["p99"] is not None and not sample["outage"]), default=None)
+        if worst_p99 is not None and worst_p99 * 1000 > self.args.max_latency_ms:
+            self.failures.append(f'relay p99 reached {worst_p99 * 1000:.0f} ms (limit {self.args.max_latency_ms} ms)')
+
+        if self.marker and self.lost / self.marker > self.args.max_loss:
+            self.failures.append(f'{self.lost} of {self.marker} pushed messages never reached discord')
+
+        return not self.failures
+
+    async def run(self) -> bool:
+        loop = asyncio.get_event_loop()
+        work_directory = tempfile.mkdtemp(prefix='bridge-soak-')
+
+        peer = Scripted_BE_Peer(RCON_PASSWORD, drop_part_rate=self.args.drop_part_rate)
+        await peer.start(loop)
+
+        channels = [Fake_Channel(DEBUG_CHANNEL_ID, 'logs', self.on_send), Fake_Channel(DAYZ_CHANNEL_ID, 'bridge', self.on_send),
+                    Fake_Channel(MODERATION_CHANNEL_ID, 'moderation', self.on_send)]
+        discord_client = Fake_Discord_Client(loop, Fake_Guild(GUILD_ID, 'Soak', channels))
+
+        config_service = bridge_config.Config_Service(os.path.join(work_directory, 'bec_server_config.json'))
+        config_service.write(config_service.validate({
+            "guild_alias": "soak",
+            "guild_id": GUILD_ID,
+            "bec_server_ipv4": "127.0.0.1",
+            "bec_rcon_port": peer.port,
+            "bec_rcon_password": RCON_PASSWORD,
+            "guild_debug_channel": DEBUG_CHANNEL_ID,
+            "guild_dayz_channel": DAYZ_CHANNEL_ID,
+            "guild_moderation_channel": MODERATION_CHANNEL_ID,
+            "maximum_reconnect_attempts": 1000000,
+            "reconnect_attempt_interval_s": 1,
+            "snapshot_interval_s": 5,
+        }))
+
+        # Short timeouts, so outages are noticed and recovered from within seconds rather than minutes.
+        bec_client = bec_rcon.ARC('127.0.0.1', RCON_PASSWORD, peer.port,
+                                  {"autoConnect": False, "timeoutSec": 3, "circuitResetSec": 2}, loop=loop)
+        bridge = Server_Bridge(discord_client, bec_client, config_service)
+        bridge.snapshot_store = bridge_snapshot.Snapshot_Store(os.path.join(work_directory, 'bridge_snapshot.bin'))
+        bridge.player_stats = bridge_stats.Player_Stats(os.path.join(work_directory, 'stats'))
+        bridge.audit_log = bridge_audit.Audit_Log(os.path.join(work_directory, 'audit.log'))
+        # A broadcast every minute, so background sends share the connection with the relay throughout.
+        schedule_path = os.path.join(work_directory, 'bec_broadcasts.json')
+        with open(schedule_path, 'w') as schedule_file:
+            json.dump({"broadcasts": [{"name": "soak", "cron": "* * * * *", "message": "Soak broadcast"}]}, schedule_file)
+        bridge.broadcaster = bridge_broadcasts.Broadcast_Scheduler(
+            bridge.managed_clients, os.path.join(work_directory, 'bec_server_lore.json'), schedule_path,
+            os.path.join(work_directory, 'bec_broadcasts_state.json'))
+
+        self.report(f'Soaking for {self.args.duration_s}s against a scripted peer on port {peer.port}, '
+                    f'files in {work_directory}')
+        await bridge.start()
+        self.logins = peer.logins
+
+        traffic = [asyncio.ensure_future(self.push_traffic(peer)),
+                   asyncio.ensure_future(self.discord_traffic(bridge, channels[1])),
+                   asyncio.ensure_future(self.chaos(peer))]
+
+        started = self.interval_start = time.monotonic()
+        try:
+            while time.monotonic() - started < self.args.duration_s:
+                await asyncio.sleep(min(self.args.sample_s, self.args.duration_s - (time.monotonic() - started)))
+                self.sample(started, bridge, peer)
+        finally:
+            for task in traffic: task.cancel()
+            bec_client.terminated = True
+            bec_client.disconnect()
+            peer.stop()
+
+        passed = self.evaluate()
+        self.report(f'relayed {self.delivered} of {self.marker} pushed messages, {self.lost} lost, '
+                    f'{self.say_errors} failed discord to rcon relays, {peer.logins} logins, '
+                    f'receive stats {bec_client.getReceiveStats()}')
+        for failure in self.failures: self.report(f'FAIL: {failure}')
+        self.report('PASS' if passed else 'FAILED')
+        return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak the RCON bridge against a scripted BattlEye peer.')
+    parser.add_argument('--duration-s', type=float, default=3600, help='how long to run (default one hour)')
+    parser.add_argument('--warmup-s', type=float, default=120, help='growth is measured from the first sample after this')
+    parser.add_argument('--sample-s', type=float, default=30, help='seconds between samples')
+    parser.add_argument('--push-rate', type=float, default=20, help='chat lines the peer pushes per second')
+    parser.add_argument('--say-rate', type=float, default=0.5, help='discord messages relayed to the server per second')
+    parser.add_argument('--outage-every-s', type=float, default=300, help='seconds between outages of the peer')
+    parser.add_argument('--downtime-s', type=float, default=10, help='length of each outage')
+    parser.add_argument('--drop-part-rate', type=float, default=0.01, help='share of multi packet answer parts lost')
+    parser.add_argument('--max-rss-growth-mb', type=float, default=25)
+    parser.add_argument('--max-task-growth', type=int, default=20)
+    parser.add_argument('--max-thread-growth', type=int, default=2)
+    parser.add_argument('--max-fd-growth', type=int, default=5)
+    parser.add_argument('--max-latency-ms', type=float, default=500)
+    parser.add_argument('--max-loss', type=float, default=0.01, help='largest share of pushed lines allowed to go missing')
+    parser.add_argument('--verbose', action='store_true', help="show the bridge's own output")
+    args = parser.parse_args()
+
+    harness = Soak_Harness(args)
+
+    # The bridge prints every relayed line; at soak rates that drowns out the samples.
+    with open(os.devnull, 'w') as devnull:
+        if not args.verbose: sys.stdout = devnull
+        try:
+            passed = asyncio.get_event_loop().run_until_complete(harness.run())
+        finally:
+            sys.stdout = harness.output
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
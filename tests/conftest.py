@@ -0,0 +1,5 @@
+import logging
+import bec_rcon
+
+# ARC attaches the rotating bec_rcon.log handler next to the module on first use; keep the tests from writing it.
+bec_rcon.my_handler = logging.NullHandler()
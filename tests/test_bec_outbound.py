@@ -0,0 +1,42 @@
+import struct
+import zlib
+from bec_outbound import Outbound_Builder, Message_Template
+
+
+def test_truncate_keeps_short_parts():
+    parts = [b'Say -1 ', b'hello']
+    assert Outbound_Builder.truncate(parts, 12) is parts
+
+
+def test_truncate_cuts_across_parts():
+    assert Outbound_Builder.truncate([b'abc', b'defg', b'hi'], 5) == [b'abc', b'de']
+    assert Outbound_Builder.truncate([b'abc', b'defg'], 3) == [b'abc']
+
+
+def test_truncate_never_splits_a_character():
+    text = 'aé€😀'.encode('utf-8')     # 1, 2, 3 and 4 byte characters
+    for limit in range(len(text) + 1):
+        kept = b''.join(Outbound_Builder.truncate([text], limit))
+        assert len(kept) <= limit
+        assert text.startswith(kept)
+        kept.decode('utf-8')
+    assert Outbound_Builder.truncate([b'ab', 'é'.encode('utf-8')], 3) == [b'ab']
+
+
+def test_command_packet_checksum():
+    parts = [b'Say 4 ', 'Grüße'.encode('utf-8'), b' from discord']
+    packet = Outbound_Builder.command_packet(parts, 42)
+    assert packet[:2] == b'BE'
+    assert packet[6:9] == b'\xff\x01\x2a'
+    assert packet[9:] == b''.join(parts)
+    assert struct.unpack_from('<I', packet, 2)[0] == zlib.crc32(packet[6:])
+
+
+def test_say_parts_fit_the_limit():
+    builder = Outbound_Builder(say_limit_bytes=10)
+    template = Message_Template('{username}: {content}', cached=('username',))
+    parts = builder.say_parts(-1, template, {'username': 'Ann', 'content': 'ü' * 20})
+    assert parts[0] == b'Say -1 '
+    message = b''.join(parts[1:])
+    assert len(message) <= 10
+    assert message.decode('utf-8') == 'Ann: üü'
@@ -0,0 +1,122 @@
+import asyncio
+import pytest
+import bec_rcon
+from bec_capture import Replay_ARC
+from bec_outbound import Outbound_Builder
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.monotonic() as seen by the circuit breaker; advance it by adding to clock[0]."""
+
+    clock = [1000.0]
+    monkeypatch.setattr(bec_rcon.time, 'monotonic', lambda: clock[0])
+    return clock
+
+
+def test_circuit_opens_after_threshold(clock):
+    circuit = bec_rcon.Circuit_Breaker(failureThreshold=3, resetTimeoutSec=10, probeTimeoutSec=30)
+    for _ in range(2):
+        circuit.recordFailure()
+        assert circuit.state == circuit.CLOSED and circuit.allow()
+
+    circuit.recordFailure()
+    assert circuit.state == circuit.OPEN
+    assert circuit.blocked() and not circuit.allow()
+    assert circuit.retryIn() == 10
+    with pytest.raises(bec_rcon.Circuit_Open_Error):
+        circuit.check('players')
+
+
+def test_circuit_lets_one_probe_through(clock):
+    circuit = bec_rcon.Circuit_Breaker(failureThreshold=1, resetTimeoutSec=10, probeTimeoutSec=30)
+    circuit.recordFailure()
+    clock[0] += 10
+
+    # Only checking does not use up the probe.
+    circuit.check('players', probe=False)
+    assert circuit.state == circuit.OPEN
+
+    assert circuit.allow()
+    assert circuit.state == circuit.HALF_OPEN
+    assert not circuit.allow()
+
+    circuit.recordSuccess()
+    assert circuit.state == circuit.CLOSED and circuit.failures == 0
+    assert circuit.allow()
+
+
+def test_failed_probe_reopens(clock):
+    circuit = bec_rcon.Circuit_Breaker(failureThreshold=3, resetTimeoutSec=10, probeTimeoutSec=30)
+    for _ in range(3): circuit.recordFailure()
+    clock[0] += 10
+    assert circuit.allow()
+
+    circuit.recordFailure()
+    assert circuit.state == circuit.OPEN
+    assert not circuit.allow()
+    assert circuit.retryIn() == 10
+
+
+def test_lost_probe_is_replaced(clock):
+    circuit = bec_rcon.Circuit_Breaker(failureThreshold=1, resetTimeoutSec=10, probeTimeoutSec=30)
+    circuit.recordFailure()
+    clock[0] += 10
+    assert circuit.allow()
+
+    clock[0] += 29
+    assert not circuit.allow()
+    clock[0] += 1
+    assert circuit.allow()
+    assert circuit.state == circuit.HALF_OPEN
+
+
+def answer(sequence: int, body: bytes) -> bytes:
+    """A command answer from the server; it has the same layout as a command packet."""
+    return Outbound_Builder.command_packet([body], sequence)
+
+
+def multi_part(sequence: int, count: int, index: int, data: bytes) -> bytes:
+    return answer(sequence, bytes([0, count, index]) + data)
+
+
+def test_send_answer_goes_to_command_history():
+    client = Replay_ARC()
+    cursor = client.serverCommandData.cursor()
+    client.received_CommandMessage(answer(0, b'Players on server'))
+    assert client.serverCommandData.get(cursor)[1] == 'Players on server'
+
+
+def test_pipelined_answer_resolves_its_command():
+    async def main():
+        client = Replay_ARC()
+        cursor = client.serverCommandData.cursor()
+        future = client.pendingCommands[5] = asyncio.get_running_loop().create_future()
+        client.received_CommandMessage(answer(5, b'ok'))
+        assert future.result() == 'ok'
+        assert client.serverCommandData.cursor() == cursor
+
+    asyncio.run(main())
+
+
+def test_late_answer_is_dropped():
+    client = Replay_ARC()
+    cursor = client.serverCommandData.cursor()
+    client.received_CommandMessage(answer(7, b'too late'))
+    client.received_CommandMessage(multi_part(8, 2, 0, b'half of '))
+    assert client.serverCommandData.cursor() == cursor
+    assert not client.MultiPackets
+
+
+def test_multi_packet_answer_is_joined_in_order():
+    async def main():
+        client = Replay_ARC()
+        future = client.pendingCommands[3] = asyncio.get_running_loop().create_future()
+        client.received_CommandMessage(multi_part(3, 3, 2, b'three'))
+        client.received_CommandMessage(multi_part(3, 3, 0, b'one '))
+        assert not future.done()
+        client.received_CommandMessage(multi_part(3, 3, 1, b'two '))
+        assert future.result() == 'one two three'
+        assert not client.MultiPackets
+
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import datetime
+import pytest
+from bridge_broadcasts import Broadcast, Cron_Schedule
+
+
+def test_parse_fields():
+    cron = Cron_Schedule('*/15 6,18 1-10/3 * 1-5')
+    assert cron.minutes == {0, 15, 30, 45}
+    assert cron.hours == {6, 18}
+    assert cron.days == {1, 4, 7, 10}
+    assert cron.months == set(range(1, 13))
+    assert cron.weekdays == {1, 2, 3, 4, 5}
+
+
+def test_step_from_a_start():
+    assert Cron_Schedule('5/20 * * * *').minutes == {5, 25, 45}
+
+
+def test_sunday_is_0_and_7():
+    assert Cron_Schedule('0 0 * * 7').weekdays == {0}
+    assert Cron_Schedule('0 0 * * 0').matches(datetime.datetime(2024, 1, 7))   # a Sunday
+
+
+@pytest.mark.parametrize('expression', ['* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '*/0 * * * *',
+                                        '5-1 * * * *', 'x * * * *'])
+def test_bad_expressions(expression):
+    with pytest.raises(ValueError):
+        Cron_Schedule(expression)
+
+
+def test_day_and_weekday_match_either():
+    cron = Cron_Schedule('0 12 1 * 1')
+    assert cron.matches(datetime.datetime(2024, 2, 1, 12))     # the 1st, a Thursday
+    assert cron.matches(datetime.datetime(2024, 2, 5, 12))     # a Monday
+    assert not cron.matches(datetime.datetime(2024, 2, 6, 12))
+    assert not cron.matches(datetime.datetime(2024, 2, 5, 12, 1))
+
+
+def test_restricted_weekday_alone():
+    cron = Cron_Schedule('30 * * * 1-5')
+    assert cron.matches(datetime.datetime(2024, 2, 2, 9, 30))      # a Friday
+    assert not cron.matches(datetime.datetime(2024, 2, 3, 9, 30))  # a Saturday
+
+
+def test_countdown_warns_ahead():
+    broadcast = Broadcast({"cron": "0 */4 * * *", "countdown_min": [10, 1], "message": "Restart in {minutes} min"}, {})
+    assert broadcast.due(datetime.datetime(2024, 2, 2, 7, 50)) == ['Restart in 10 min']
+    assert broadcast.due(datetime.datetime(2024, 2, 2, 7, 59)) == ['Restart in 1 min']
+    assert broadcast.due(datetime.datetime(2024, 2, 2, 8, 0)) == []
@@ -0,0 +1,37 @@
+import pytest
+from bridge_snapshot import Snapshot_Store
+
+STATE = {"version": 1, "players": [{"name": "Grüße", "guid": "abc", "ip": None}], "cursors": {"chat": 12}}
+
+
+def test_round_trip(tmp_path):
+    store = Snapshot_Store(str(tmp_path / 'snapshot.bin'))
+    assert store.read() is None
+    assert store.write(dict(STATE, saved_at=1.0))
+
+    snapshot = store.read()
+    assert snapshot.pop("saved_at") > 1.0
+    assert snapshot == STATE
+    assert Snapshot_Store.decode(Snapshot_Store.encode(STATE)) == STATE
+
+
+def test_empty_state(tmp_path):
+    store = Snapshot_Store(str(tmp_path / 'snapshot.bin'))
+    assert store.write({})
+    assert list(store.read()) == ["saved_at"]
+
+
+def test_unchanged_state_is_not_written(tmp_path):
+    store = Snapshot_Store(str(tmp_path / 'snapshot.bin'))
+    assert store.write(dict(STATE, saved_at=1.0))
+    assert not store.write(dict(STATE, saved_at=2.0))
+    assert store.write(dict(STATE, version=2))
+
+
+@pytest.mark.parametrize('damage', [lambda data: data[:-1] + bytes([data[-1] ^ 1]), lambda data: data[:7],
+                                    lambda data: b'XXXX' + data[4:]])
+def test_damaged_snapshot_is_ignored(tmp_path, damage):
+    path = tmp_path / 'snapshot.bin'
+    Snapshot_Store(str(path)).write(STATE)
+    path.write_bytes(damage(path.read_bytes()))
+    assert Snapshot_Store(str(path)).read() is None
@@ -0,0 +1,64 @@
+import asyncio
+import bridge_stats
+from bridge_stats import DAY_S, Player_Stats
+
+# Eight days from midnight UTC: 50 players from 12:00 to 12:59 every day, 5 otherwise, one sample a minute,
+# and a single minute at 60 on the sixth day.
+BEGIN = 20000 * DAY_S
+PEAK_TIME = BEGIN + 5 * DAY_S + 12 * 3600 + 1800
+END = BEGIN + 8 * DAY_S
+
+
+def feed(stats: Player_Stats, begin: int = BEGIN, end: int = END):
+    for now in range(begin, end, 60):
+        players = 50 if now // 3600 % 24 == 12 else 5
+        if now == PEAK_TIME: players = 60
+        stats.record(players, now=now)
+
+
+def contents(stats: Player_Stats) -> list:
+    return [[series.record(index) for index in range(len(series))] for series in stats.series]
+
+
+def test_summary_over_every_tier(tmp_path):
+    stats = Player_Stats(str(tmp_path))
+    feed(stats)
+    now = END - 60
+
+    # 3d is all hours and minutes, 7d and 8d take whole days from the day tier.
+    for range_s in (DAY_S, 3 * DAY_S, 7 * DAY_S, 8 * DAY_S):
+        summary = stats.summary(range_s, now)
+        hourly = summary["hourly_average"]
+        # The spike is in every range but the last day, where the first minute at 50 is the peak.
+        if range_s > DAY_S:
+            assert (summary["peak"], summary["peak_at"]) == (60, PEAK_TIME), range_s
+        else:
+            assert (summary["peak"], summary["peak_at"]) == (50, BEGIN + 7 * DAY_S + 12 * 3600), range_s
+        assert summary["low"] == 5, range_s
+        assert max(range(24), key=lambda hour: hourly[hour] or 0) == 12, range_s
+        assert all(abs(hourly[hour] - 5) < 1e-9 for hour in range(24) if hour != 12), range_s
+
+
+def test_files_load_back(tmp_path):
+    stats = Player_Stats(str(tmp_path))
+    feed(stats, end=BEGIN + 2 * DAY_S)
+    stats.flush()
+    assert contents(Player_Stats(str(tmp_path))) == contents(stats)
+
+
+def test_trimmed_series_written_from_the_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(bridge_stats, 'TIERS', (('minute', 60, 3600),) + bridge_stats.TIERS[1:])
+
+    async def main():
+        stats = Player_Stats(str(tmp_path)).start()
+        for now in range(BEGIN, BEGIN + 5 * 3600, 60):
+            stats.record(7, now=now)
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.2)
+        stats.writer_task.cancel()
+        stats.flush()
+        return stats
+
+    stats = asyncio.run(main())
+    assert stats.series[0].starts[0] > BEGIN     # trimmed
+    assert contents(Player_Stats(str(tmp_path))) == contents(stats)